@@ -0,0 +1,207 @@
+# Sweep build/runtime settings of ArcFace and FastDepth TVM libraries and
+# write percentile latencies, throughput and build time to JSON/CSV reports.
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import tvm
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(ROOT, "template", "python"),
+    os.path.join(ROOT, "insightface", "python"),
+    os.path.join(ROOT, "fastdepth"),
+]
+
+from tvm_perf_history import PerfHistory  # noqa: E402
+from tvm_serving_utils import config_threadpool  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+MODELS = ("arcface", "fastdepth-v1", "fastdepth-v2")
+
+
+def latency_stats(samples_ms):
+    return {
+        "mean_ms": float(np.mean(samples_ms)),
+        "std_ms": float(np.std(samples_ms)),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p90_ms": float(np.percentile(samples_ms, 90)),
+        "p99_ms": float(np.percentile(samples_ms, 99)),
+        "max_ms": float(np.max(samples_ms)),
+    }
+
+
+def arcface_tool(args, batch_size, layout, opt_level, target):
+    from main import ArcFaceUtils
+    return ArcFaceUtils(args.arcface_prefix,
+                        args.arcface_epoch,
+                        "arcface-mobilefacenet", (batch_size, 3, 112, 112),
+                        target,
+                        layout,
+                        cache_dir=args.cache_dir,
+                        opt_level=opt_level)
+
+
+def fastdepth_tool(args, version, batch_size, layout, opt_level, target):
+    from fastdepth import get_scripted_moidel
+    from fastdepth_to_tvm import pytorch_to_tvm
+    from tvm_development_utils import TvmDevelopmentUtils
+
+    pth_path = args.fastdepth_v1 if version == "v1" else args.fastdepth_v2
+
+    class FastDepthUtils(TvmDevelopmentUtils):
+        def network_fn(self):
+            scripted_model = get_scripted_moidel(version, pth_path,
+                                                 list(self.image_size))
+            return pytorch_to_tvm(scripted_model, self.image_size)
+
+    return FastDepthUtils(f"fastdepth-{version}", (batch_size, 3, 224, 224),
+                          target,
+                          layout,
+                          cache_dir=args.cache_dir,
+                          opt_level=opt_level)
+
+
+def make_tool(args, model, batch_size, layout, opt_level):
+    target = tvm.target.Target(args.target)
+    if model == "arcface":
+        return arcface_tool(args, batch_size, layout, opt_level,
+                            target), "data"
+    return fastdepth_tool(args, model.split("-")[1], batch_size, layout,
+                          opt_level, target), "input0"
+
+
+def run_matrix(args):
+    records = []
+    history = PerfHistory(args.history) if args.history else None
+    build_cases = itertools.product(args.models, args.batch_sizes,
+                                    args.layouts, args.opt_levels,
+                                    args.tuned)
+    for model, batch_size, layout, opt_level, tuned in build_cases:
+        tool, input_name = make_tool(args, model, batch_size, layout,
+                                     opt_level)
+        tool.log_file = os.path.join(args.log_dir,
+                                     os.path.basename(tool.log_file))
+        tuned = tuned == "tuned"
+        if not tuned:
+            tool.log_file = None
+        elif not os.path.exists(tool.log_file):
+            # an untuned run would be recorded under the tuned label
+            logger.warning(f"skip tuned {model} batch {batch_size} {layout} "
+                           f"O{opt_level}: no tuning log {tool.log_file}")
+            continue
+        start = time.perf_counter()
+        tool.lib
+        build_s = time.perf_counter() - start
+
+        inputs = np.random.uniform(size=tool.image_size).astype("float32")
+        for num_threads in args.num_threads:
+            config_threadpool(num_threads)
+            tool.inference(inputs, input_name)
+            ftimer = tool.module.module.time_evaluator("run",
+                                                       tool.dev,
+                                                       number=1,
+                                                       repeat=args.num_runs)
+            samples_ms = np.array(ftimer().results) * 1e3
+            record = {
+                "model": model,
+                "batch_size": batch_size,
+                "layout": layout,
+                "num_threads": num_threads,
+                "opt_level": opt_level,
+                "tuned": tuned,
+                "target": args.target,
+                "build_s": build_s,
+            }
+            record.update(latency_stats(samples_ms))
+            record["throughput"] = batch_size * 1e3 / record["mean_ms"]
+            logger.info(
+                "%s batch %d %s %d threads O%d %s: p50 %.2f ms, "
+                "p99 %.2f ms, %.1f samples/s" %
+                (model, batch_size, layout, num_threads, opt_level,
+                 "tuned" if tuned else "untuned", record["p50_ms"],
+                 record["p99_ms"], record["throughput"]))
+            records.append(record)
+            if history is not None:
+                history.append(model,
+                               args.target,
+                               samples_ms,
+                               config={
+                                   "batch_size": batch_size,
+                                   "layout": layout,
+                                   "num_threads": num_threads,
+                                   "opt_level": opt_level,
+                                   "tuned": tuned,
+                               },
+                               log_file=tool.log_file,
+                               lib=tool.lib)
+    return records
+
+
+def write_report(records, output):
+    if not records:
+        logger.warning("no records to write")
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(records, f, indent=2)
+    csv_path = os.path.splitext(output)[0] + ".csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
+        writer.writeheader()
+        writer.writerows(records)
+    logger.info(f"write {len(records)} records to {output} and {csv_path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="TVM benchmark matrix")
+    parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--layouts",
+                        nargs="+",
+                        default=["NCHW", "NHWC"],
+                        choices=["NCHW", "NHWC"])
+    parser.add_argument("--num-threads",
+                        nargs="+",
+                        type=int,
+                        default=[os.cpu_count()])
+    parser.add_argument("--opt-levels", nargs="+", type=int, default=[3])
+    parser.add_argument("--tuned",
+                        nargs="+",
+                        default=["untuned", "tuned"],
+                        choices=["untuned", "tuned"])
+    parser.add_argument("--num-runs", type=int, default=200)
+    parser.add_argument("--target", default="llvm")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--log-dir",
+                        default=".",
+                        help="directory of auto-scheduler tuning logs")
+    parser.add_argument("--output", default="reports/benchmark.json")
+    parser.add_argument("--history",
+                        default=None,
+                        help="jsonl performance history to append to, "
+                        "see template/python/tvm_perf_history.py")
+    parser.add_argument("--arcface-prefix",
+                        default=os.path.join(
+                            ROOT, "data/insightface/model-y1-test2/model"))
+    parser.add_argument("--arcface-epoch", type=int, default=0)
+    parser.add_argument("--fastdepth-v1",
+                        default=os.path.join(
+                            ROOT, "data/fastdepth/FastDepth_L1GN_Best.pth"))
+    parser.add_argument("--fastdepth-v2",
+                        default=os.path.join(
+                            ROOT, "data/fastdepth/FastDepthV2_L1GN_Best.pth"))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    write_report(run_matrix(args), args.output)
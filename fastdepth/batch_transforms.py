@@ -0,0 +1,188 @@
+# Batched NumPy version of `NYUDataset.val_transform`, bit-exact with the
+# PIL path (`Image.resize` with BILINEAR, which torchvision `Resize` uses)
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# same fixed-point precision as Pillow for 8-bit images
+PRECISION_BITS = 32 - 8 - 2
+
+
+def _resize_coeffs(in_size, out_size):
+    # port of Pillow `precompute_coeffs` for the bilinear filter, returns
+    # the first input index and the (zero padded) weights per output index
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 1.0 * filterscale
+    ksize = int(np.ceil(support)) * 2 + 1
+    bounds = np.zeros(out_size, np.int64)
+    weights = np.zeros((out_size, ksize), np.float64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        ss = 1.0 / filterscale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size) - xmin
+        w = [
+            max(1.0 - abs((x + xmin - center + 0.5) * ss), 0.0)
+            for x in range(xmax)
+        ]
+        ww = sum(w)
+        bounds[xx] = xmin
+        weights[xx, :xmax] = [v / ww if ww != 0.0 else v for v in w]
+    return bounds, weights
+
+
+def _resize_axis(batch, axis, bounds, weights, uint8, channels=1):
+    # one separable pass along `axis`, summing taps in the same order as
+    # Pillow. uint8 uses Pillow's integer coefficients and rounding, exact
+    # in int32 since the coefficients sum to 2^PRECISION_BITS. float32
+    # accumulates in float64 like Pillow does. With `channels` > 1, `axis`
+    # holds interleaved channels, e.g. W * C of a N x H x (W * C) batch
+    in_size = batch.shape[axis] // channels
+    # zero padded taps past the longest kernel don't contribute
+    weights = weights[:, :int(np.max(np.sum(weights != 0, axis=1)))]
+    if uint8:
+        weights = np.floor(weights * (1 << PRECISION_BITS) + 0.5)
+        weights = weights.astype(np.int32)
+    out_shape = list(batch.shape)
+    out_shape[axis] = len(bounds) * channels
+    acc = np.full(out_shape, 1 << (PRECISION_BITS - 1) if uint8 else 0,
+                  np.int32 if uint8 else np.float64)
+    shape = [1] * batch.ndim
+    shape[axis] = -1
+    for k in range(weights.shape[1]):
+        indices = np.minimum(bounds + k, in_size - 1)
+        indices = (indices[:, None] * channels +
+                   np.arange(channels)).reshape(-1)
+        acc += np.take(batch, indices, axis=axis) * np.repeat(
+            weights[:, k], channels).reshape(shape)
+    if uint8:
+        return np.clip(acc >> PRECISION_BITS, 0, 255).astype(np.uint8)
+    return acc.astype(np.float32)
+
+
+def resize_bilinear(batch, size, crop=None):
+    # `batch`: N x H x W x C (or N x H x W), uint8 or float32.
+    # `size`: (height, width). `crop`: (top, left, height, width) of the
+    # resized image, fused by only computing the rows/columns it keeps
+    num, height, width = batch.shape[:3]
+    channels = batch.shape[3] if batch.ndim == 4 else 1
+    out_channels = batch.shape[3:]
+    uint8 = batch.dtype == np.uint8
+    if not uint8:
+        batch = batch.astype(np.float32, copy=False)
+    batch = batch.reshape(num, height, width * channels)
+    top, left, out_h, out_w = crop or (0, 0) + tuple(size)
+
+    # like Pillow: horizontal pass first, only on the rows the vertical
+    # pass reads. A pass is skipped when its size doesn't change
+    if size[0] != height:
+        v_bounds, v_weights = _resize_coeffs(height, size[0])
+        v_bounds = v_bounds[top:top + out_h]
+        v_weights = v_weights[top:top + out_h]
+        first = int(v_bounds[0])
+        last = int(np.max(v_bounds + np.sum(v_weights != 0, axis=1)))
+        batch = batch[:, first:last]
+        v_bounds = v_bounds - first
+    else:
+        batch = batch[:, top:top + out_h]
+    if size[1] != width:
+        bounds, weights = _resize_coeffs(width, size[1])
+        batch = _resize_axis(batch, 2, bounds[left:left + out_w],
+                             weights[left:left + out_w], uint8, channels)
+    else:
+        batch = batch[:, :, left * channels:(left + out_w) * channels]
+    if size[0] != height:
+        batch = _resize_axis(batch, 1, v_bounds, v_weights, uint8)
+    return batch.reshape((num, out_h, out_w) + out_channels)
+
+
+def center_crop_box(size, crop_size):
+    # same rounding as torchvision `CenterCrop`
+    top = int(round((size[0] - crop_size[0]) / 2.0))
+    left = int(round((size[1] - crop_size[1]) / 2.0))
+    return top, left, crop_size[0], crop_size[1]
+
+
+def _val_transform_chunk(rgb, depth, output_size):
+    iheight = rgb.shape[1]
+    dim1 = (int(250 * 480 / iheight), int(250 * 640 / iheight))
+    crop = center_crop_box(dim1, (228, 304))
+    rgb = resize_bilinear(resize_bilinear(rgb, dim1, crop), output_size)
+    depth = resize_bilinear(resize_bilinear(depth, dim1, crop), output_size)
+    rgb = rgb.transpose(0, 3, 1, 2).astype(np.float32) / np.float32(255)
+    return rgb, depth[:, np.newaxis]
+
+
+def val_transform_batch(rgb, depth, output_size=(224, 224), num_threads=1):
+    # `rgb`: N x 480 x 640 x 3 uint8, `depth`: N x 480 x 640 float32.
+    # resize (250, 333) -> center crop (228, 304) -> resize `output_size`,
+    # returns N x 3 x H x W rgb in [0, 1] and N x 1 x H x W depth like
+    # `ToTensor`. NumPy releases the GIL, so `num_threads` threads work on
+    # chunks of the batch in parallel
+    if num_threads <= 1 or len(rgb) <= 1:
+        return _val_transform_chunk(rgb, depth, output_size)
+    chunks = np.array_split(np.arange(len(rgb)), min(num_threads, len(rgb)))
+    with ThreadPoolExecutor(len(chunks)) as executor:
+        results = list(
+            executor.map(
+                lambda idx: _val_transform_chunk(rgb[idx[0]:idx[-1] + 1],
+                                                 depth[idx[0]:idx[-1] + 1],
+                                                 output_size), chunks))
+    return (np.concatenate([r for r, _ in results]),
+            np.concatenate([d for _, d in results]))
+
+
+def check_val_transform(dataset, num_samples=16, batch_size=8):
+    # max abs difference to `dataset.val_transform`, should be 0
+    rgb_diff, depth_diff = 0., 0.
+    num_samples = min(num_samples, len(dataset))
+    for start in range(0, num_samples, batch_size):
+        indices = range(start, min(start + batch_size, num_samples))
+        raws = [dataset.__getraw__(idx) for idx in indices]
+        rgb, depth = val_transform_batch(np.stack([r for r, _ in raws]),
+                                         np.stack([d for _, d in raws]),
+                                         dataset.output_size)
+        for idx, (raw_rgb, raw_depth) in enumerate(raws):
+            ref_rgb, ref_depth = dataset.val_transform(raw_rgb, raw_depth)
+            rgb_diff = max(rgb_diff,
+                           float(np.abs(rgb[idx] - ref_rgb.numpy()).max()))
+            depth_diff = max(
+                depth_diff,
+                float(np.abs(depth[idx] - ref_depth.numpy()).max()))
+    return rgb_diff, depth_diff
+
+
+if __name__ == '__main__':
+    from nyudepthv2 import NYUDataset, PackedNYUDataset
+
+    parser = argparse.ArgumentParser(
+        description="Check and time the batched val_transform")
+    parser.add_argument("--data-dir", default="nyudepthv2/val")
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--num-threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.join(args.data_dir, "index.npy")):
+        dataset = PackedNYUDataset(args.data_dir, train=False)
+    else:
+        dataset = NYUDataset(args.data_dir, train=False)
+    print("max abs diff to val_transform, rgb: %g, depth: %g" %
+          check_val_transform(dataset, args.num_samples, args.batch_size))
+
+    raws = [dataset.__getraw__(idx) for idx in range(args.batch_size)]
+    rgb = np.stack([r for r, _ in raws])
+    depth = np.stack([d for _, d in raws])
+    start = time.perf_counter()
+    for raw_rgb, raw_depth in raws:
+        dataset.val_transform(raw_rgb, raw_depth)
+    pil_ms = (time.perf_counter() - start) * 1e3 / args.batch_size
+    start = time.perf_counter()
+    val_transform_batch(rgb, depth, dataset.output_size, args.num_threads)
+    batch_ms = (time.perf_counter() - start) * 1e3 / args.batch_size
+    print("per sample: val_transform %.2f ms, batched %.2f ms "
+          "(%d threads)" % (pil_ms, batch_ms, args.num_threads))
@@ -0,0 +1,159 @@
+# Stream the NYU Depth v2 val split through a TVM FastDepth library: reading
+# and preprocessing run in background threads while the main thread runs
+# batched inference and updates the metrics
+
+import argparse
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tvm
+import tvm.relay as relay
+from tvm.contrib import graph_executor
+
+from batch_transforms import val_transform_batch
+from fastdepth_to_tvm import INPUT_NAME
+from metrics import DepthMetrics
+from nyudepthv2 import NYUDataset, PackedNYUDataset
+
+
+class StageTimer:
+    # seconds spent per stage, summed over threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = collections.defaultdict(float)
+
+    def add(self, stage, start):
+        with self._lock:
+            self.seconds[stage] += time.perf_counter() - start
+
+
+def load_dataset(data_dir):
+    if os.path.exists(os.path.join(data_dir, "index.npy")):
+        return PackedNYUDataset(data_dir, train=False)
+    return NYUDataset(data_dir, train=False)
+
+
+def _load_batch(dataset, indices, batch_size, timer, num_threads):
+    start = time.perf_counter()
+    raws = [dataset.__getraw__(idx) for idx in indices]
+    rgb = np.stack([r for r, _ in raws])
+    depth = np.stack([d for _, d in raws])
+    timer.add("io", start)
+
+    start = time.perf_counter()
+    rgb, depth = val_transform_batch(rgb, depth, dataset.output_size,
+                                     num_threads)
+    if len(rgb) < batch_size:
+        # the library has a static batch size, padded rows are ignored
+        rgb = np.concatenate(
+            [rgb, np.zeros((batch_size - len(rgb), ) + rgb.shape[1:],
+                           rgb.dtype)])
+    timer.add("preprocess", start)
+    return rgb, depth
+
+
+def evaluate_stream(lib,
+                    dataset,
+                    num_samples=None,
+                    dev=tvm.cpu(0),
+                    num_workers=2,
+                    prefetch=4,
+                    preprocess_threads=1):
+    # `num_workers` threads read and preprocess up to `prefetch` batches
+    # ahead of inference. Only the running metrics are kept
+    m = graph_executor.GraphModule(lib["default"](dev))
+    batch_size = m.get_input(0).shape[0]
+    num_samples = min(num_samples or len(dataset), len(dataset))
+    batches = [
+        range(start, min(start + batch_size, num_samples))
+        for start in range(0, num_samples, batch_size)
+    ]
+    metrics = DepthMetrics()
+    timer = StageTimer()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_workers) as executor:
+        pending = collections.deque()
+        for indices in batches:
+            pending.append(
+                executor.submit(_load_batch, dataset, indices, batch_size,
+                                timer, preprocess_threads))
+            if len(pending) < prefetch:
+                continue
+            _run_batch(m, pending.popleft(), metrics, timer)
+        while pending:
+            _run_batch(m, pending.popleft(), metrics, timer)
+    wall_s = time.perf_counter() - start
+
+    stages = dict(timer.seconds)
+    stages["wall"] = wall_s
+    return metrics, num_samples / wall_s, stages
+
+
+def _run_batch(m, future, metrics, timer):
+    # "wait" is the time inference is starved by reading/preprocessing
+    start = time.perf_counter()
+    rgb, depth = future.result()
+    timer.add("wait", start)
+
+    start = time.perf_counter()
+    m.set_input(INPUT_NAME, rgb)
+    m.run()
+    pred = m.get_output(0).asnumpy()
+    timer.add("inference", start)
+
+    start = time.perf_counter()
+    metrics.update(pred[:len(depth)], depth)
+    timer.add("metrics", start)
+
+
+def main(args):
+    if args.lib is not None:
+        lib = tvm.runtime.load_module(args.lib)
+    else:
+        from fastdepth import get_scripted_moidel
+        from fastdepth_to_tvm import pytorch_to_tvm
+
+        input_shape = (args.batch_size, 3, 224, 224)
+        scripted_model = get_scripted_moidel(args.model_type, args.pth_path,
+                                             list(input_shape))
+        mod, params = pytorch_to_tvm(scripted_model, input_shape)
+        with tvm.transform.PassContext(opt_level=3):
+            lib = relay.build(mod, target=args.target, params=params)
+
+    dataset = load_dataset(args.data_dir)
+    metrics, images_per_s, stages = evaluate_stream(
+        lib, dataset, args.num_samples, tvm.cpu(0), args.num_workers,
+        args.prefetch, args.preprocess_threads)
+    print(metrics)
+    # io/preprocess are summed over worker threads, so they may exceed
+    # the wall time when they overlap
+    print("%.2f images/s, " % images_per_s + ", ".join(
+        "%s %.2f s" % (stage, seconds)
+        for stage, seconds in stages.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Evaluate FastDepth TVM library on NYU Depth v2")
+    parser.add_argument("--lib",
+                        default=None,
+                        help="exported library, built from --pth-path "
+                        "if not set")
+    parser.add_argument("--model-type", default="v2", choices=["v1", "v2"])
+    parser.add_argument("--pth-path",
+                        default="../data/fastdepth/FastDepthV2_L1GN_Best.pth")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--target", default="llvm")
+    parser.add_argument("--data-dir",
+                        default="nyudepthv2/val",
+                        help="split directory of .h5 files or packed files")
+    parser.add_argument("--num-samples", type=int, default=None)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--prefetch", type=int, default=4)
+    parser.add_argument("--preprocess-threads", type=int, default=1)
+    main(parser.parse_args())
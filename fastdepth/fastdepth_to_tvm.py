@@ -1,3 +1,6 @@
+import os
+import sys
+
 import numpy as np
 import torch
 import tvm
@@ -6,12 +9,24 @@ from tvm.contrib import graph_executor
 
 from fastdepth import get_scripted_moidel
 
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "template", "python"))
+
+from frontend_examples import prepend_preprocess  # noqa: E402
+
 INPUT_NAME = "input0"
 
 
-def pytorch_to_tvm(scripted_model, input_shape):
+def pytorch_to_tvm(scripted_model, input_shape, preprocess=None):
+    # `preprocess`: None for a float32 NCHW input, or kwargs of
+    # `prepend_preprocess` for a uint8 NHWC input, e.g.
+    # `{"scale": 1 / 255}` like `ToTensor` in `NYUDataset.val_transform`
     shape_list = [(INPUT_NAME, input_shape)]
     mod, params = relay.frontend.from_pytorch(scripted_model, shape_list)
+    if preprocess is not None:
+        mod = prepend_preprocess(mod, INPUT_NAME, input_shape, **preprocess)
     return mod, params
 
 
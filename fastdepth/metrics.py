@@ -0,0 +1,47 @@
+import numpy as np
+
+
+class DepthMetrics:
+    # running depth metrics, averaged over images as in the FastDepth paper.
+    # Only pixels with valid (positive) ground truth are counted
+    def __init__(self):
+        self.num_images = 0
+        self.sums = {
+            "rmse": 0.,
+            "mae": 0.,
+            "rel": 0.,
+            "delta1": 0.,
+            "delta2": 0.,
+            "delta3": 0.,
+        }
+
+    def update(self, pred, target):
+        pred = pred.reshape(len(pred), -1)
+        target = target.reshape(len(target), -1)
+        for p, t in zip(pred, target):
+            valid = t > 0
+            if not valid.any():
+                continue
+            p, t = p[valid].astype(np.float64), t[valid].astype(np.float64)
+            abs_diff = np.abs(p - t)
+            ratio = np.maximum(p / t, t / np.maximum(p, 1e-12))
+            self.sums["rmse"] += np.sqrt(np.mean(abs_diff**2))
+            self.sums["mae"] += np.mean(abs_diff)
+            self.sums["rel"] += np.mean(abs_diff / t)
+            self.sums["delta1"] += np.mean(ratio < 1.25)
+            self.sums["delta2"] += np.mean(ratio < 1.25**2)
+            self.sums["delta3"] += np.mean(ratio < 1.25**3)
+            self.num_images += 1
+
+    def result(self):
+        return {
+            k: v / max(self.num_images, 1)
+            for k, v in self.sums.items()
+        }
+
+    def __str__(self):
+        res = self.result()
+        return ("RMSE %.4f, MAE %.4f, REL %.4f, "
+                "delta1 %.4f, delta2 %.4f, delta3 %.4f" %
+                (res["rmse"], res["mae"], res["rel"], res["delta1"],
+                 res["delta2"], res["delta3"]))
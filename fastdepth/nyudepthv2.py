@@ -1,5 +1,7 @@
 # copy from https://github.com/Hagaik92/FastDepth/blob/main/nyudepthv2.py
 # this file is needed for loading fastdepth pretrained ckpt
+import argparse
+import json
 import os
 import os.path
 import random
@@ -11,14 +13,27 @@ from PIL import Image
 from torch.utils.data import Dataset, random_split
 from torchvision import transforms
 
+from batch_transforms import val_transform_batch
+
 iheight, iwidth = 480, 640
 
 
+PACKED_RGB = "rgb.u8"
+PACKED_DEPTH = "depth.f32"
+PACKED_INDEX = "index.npy"
+PACKED_META = "meta.json"
+# one row per sample, offsets in elements of the rgb/depth files
+PACKED_INDEX_DTYPE = np.dtype([("rgb_offset", np.int64),
+                               ("depth_offset", np.int64),
+                               ("height", np.int32), ("width", np.int32),
+                               ("label", np.int32)])
+
+
 def h5_loader(path):
-    h5f = h5py.File(path, "r")
-    rgb = np.array(h5f['rgb'])
+    with h5py.File(path, "r") as h5f:
+        rgb = h5f['rgb'][()]
+        depth = h5f['depth'][()]
     rgb = np.transpose(rgb, (1, 2, 0))
-    depth = np.array(h5f['depth'])
     return rgb, depth
 
 
@@ -50,6 +65,13 @@ class NYUDataset(Dataset):
         rgb_tensor, depth_tensor = self.transform(rgb, depth)
         return rgb_tensor, depth_tensor
 
+    def get_val_batch(self, indices, num_threads=1):
+        # `val_transform` of several samples at once as numpy arrays
+        raws = [self.__getraw__(idx) for idx in indices]
+        return val_transform_batch(np.stack([rgb for rgb, _ in raws]),
+                                   np.stack([depth for _, depth in raws]),
+                                   self.output_size, num_threads)
+
     def build_dataset(self, root_dir, class_to_idx):
         images = []
         for class_name in sorted(os.listdir(root_dir)):
@@ -151,6 +173,78 @@ class NYUDataset(Dataset):
         return rgb_tensor, depth_tensor
 
 
+def pack_nyu_split(root_dir, output_dir, loader=h5_loader):
+    # one-time conversion of a split of .h5 files into contiguous uint8 rgb
+    # (HWC) and float32 depth files plus an offset index, see
+    # `PackedNYUDataset`
+    dataset = NYUDataset(root_dir, train=False, loader=loader)
+    os.makedirs(output_dir, exist_ok=True)
+    index = np.zeros(len(dataset), PACKED_INDEX_DTYPE)
+    rgb_offset, depth_offset = 0, 0
+    with open(os.path.join(output_dir, PACKED_RGB), "wb") as rgb_f, \
+            open(os.path.join(output_dir, PACKED_DEPTH), "wb") as depth_f:
+        for idx, (path, label) in enumerate(dataset.images):
+            rgb, depth = loader(path)
+            rgb = np.ascontiguousarray(rgb, np.uint8)
+            depth = np.ascontiguousarray(depth, np.float32)
+            index[idx] = (rgb_offset, depth_offset, depth.shape[0],
+                          depth.shape[1], label)
+            rgb_f.write(rgb.tobytes())
+            depth_f.write(depth.tobytes())
+            rgb_offset += rgb.size
+            depth_offset += depth.size
+    np.save(os.path.join(output_dir, PACKED_INDEX), index)
+    with open(os.path.join(output_dir, PACKED_META), "w") as f:
+        json.dump(
+            {
+                "num_samples": len(dataset),
+                "classes": dataset.classes,
+                "source": os.path.abspath(root_dir),
+            },
+            f,
+            indent=2)
+    print(f"pack {len(dataset)} samples of {root_dir} to {output_dir}")
+
+
+class PackedNYUDataset(NYUDataset):
+    def __init__(self, packed_dir, train):
+        # the files of `pack_nyu_split` are memory-mapped, so construction
+        # doesn't depend on the number of samples and `__getraw__` is a
+        # slice without any file open
+        self.output_size = (224, 224)
+        self.root_dir = packed_dir
+        self.train = train
+        with open(os.path.join(packed_dir, PACKED_META)) as f:
+            meta = json.load(f)
+        self.classes = meta["classes"]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.index = np.load(os.path.join(packed_dir, PACKED_INDEX),
+                             mmap_mode="r")
+        self.rgb = np.memmap(os.path.join(packed_dir, PACKED_RGB),
+                             np.uint8,
+                             mode="r")
+        self.depth = np.memmap(os.path.join(packed_dir, PACKED_DEPTH),
+                               np.float32,
+                               mode="r")
+        self.modality = 'rgb'
+        if self.train:
+            self.transform = self.train_transform
+        else:
+            self.transform = self.val_transform
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getraw__(self, index):
+        rgb_offset, depth_offset, height, width, _ = self.index[index]
+        num_pixels = int(height) * int(width)
+        rgb = self.rgb[rgb_offset:rgb_offset + num_pixels * 3].reshape(
+            height, width, 3)
+        depth = self.depth[depth_offset:depth_offset + num_pixels].reshape(
+            height, width)
+        return rgb, depth
+
+
 def create_data_loaders(args):
     print('Creating dataset... patience.')
     train_path = os.path.join('nyudepthv2', 'train')
@@ -192,3 +286,11 @@ def create_data_loaders(args):
                                              pin_memory=True)
     print('Finish loading datasets')
     return train_loader, val_loader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack a NYU Depth v2 split")
+    parser.add_argument("root_dir", help="e.g. nyudepthv2/val")
+    parser.add_argument("output_dir", help="e.g. nyudepthv2_packed/val")
+    args = parser.parse_args()
+    pack_nyu_split(args.root_dir, args.output_dir)
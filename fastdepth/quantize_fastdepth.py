@@ -0,0 +1,101 @@
+# INT8 post-training quantization of FastDepth, calibrated on NYU Depth v2
+
+import argparse
+import os
+
+import numpy as np
+import tvm
+import tvm.relay as relay
+from tvm.contrib import graph_executor
+
+from fastdepth import get_scripted_moidel
+from fastdepth_to_tvm import INPUT_NAME, pytorch_to_tvm
+from metrics import DepthMetrics
+from nyudepthv2 import NYUDataset
+
+
+def calibration_dataset(dataset, num_samples, seed=0):
+    # relay.quantize iterates over dicts of input name -> batch
+    num_samples = min(num_samples, len(dataset))
+    indices = np.random.RandomState(seed).choice(len(dataset),
+                                                 num_samples,
+                                                 replace=False)
+    samples = []
+    for idx in indices:
+        rgb, _ = dataset[idx]
+        samples.append({INPUT_NAME: rgb.unsqueeze(0).numpy()})
+    return samples
+
+
+def quantize(mod, params, calib_samples, calibrate_mode="kl_divergence",
+             weight_scale="max"):
+    with relay.quantize.qconfig(calibrate_mode=calibrate_mode,
+                                weight_scale=weight_scale):
+        mod = relay.quantize.quantize(mod, params, dataset=calib_samples)
+    return mod
+
+
+def build(mod, params, target):
+    with tvm.transform.PassContext(opt_level=3):
+        return relay.build(mod, target=target, params=params)
+
+
+def evaluate(lib, dataset, num_samples, dev=tvm.cpu(0)):
+    m = graph_executor.GraphModule(lib["default"](dev))
+    metrics = DepthMetrics()
+    for idx in range(min(num_samples, len(dataset))):
+        rgb, depth = dataset[idx]
+        m.set_input(INPUT_NAME, tvm.nd.array(rgb.unsqueeze(0).numpy()))
+        m.run()
+        metrics.update(m.get_output(0).asnumpy(), depth.unsqueeze(0).numpy())
+    ftimer = m.module.time_evaluator("run", dev, repeat=3, min_repeat_ms=500)
+    latency_ms = np.mean(ftimer().results) * 1e3
+    return metrics, latency_ms
+
+
+def main(args):
+    input_shape = (1, 3, 224, 224)
+    target = tvm.target.Target(args.target)
+    scripted_model = get_scripted_moidel(args.model_type, args.pth_path,
+                                         list(input_shape))
+    mod, params = pytorch_to_tvm(scripted_model, input_shape)
+
+    # calibrate with val_transform, on the train split by default so that
+    # the accuracy on the val split is not biased by calibration
+    calib_dataset = NYUDataset(os.path.join(args.nyu_root, args.calib_split),
+                               train=False)
+    calib_samples = calibration_dataset(calib_dataset, args.calib_samples)
+    qmod = quantize(mod, params, calib_samples, args.calibrate_mode)
+
+    val_dataset = NYUDataset(os.path.join(args.nyu_root, "val"), train=False)
+    fp32_metrics, fp32_ms = evaluate(build(mod, params, target), val_dataset,
+                                     args.val_samples)
+    int8_lib = build(qmod, None, target)
+    int8_metrics, int8_ms = evaluate(int8_lib, val_dataset, args.val_samples)
+    if args.export_lib is not None:
+        int8_lib.export_library(args.export_lib)
+
+    fp32_res, int8_res = fp32_metrics.result(), int8_metrics.result()
+    print("fp32: %.2f ms, %s" % (fp32_ms, fp32_metrics))
+    print("int8: %.2f ms, %s" % (int8_ms, int8_metrics))
+    print("speed-up: %.2fx, RMSE delta: %+.4f, delta1 delta: %+.4f" %
+          (fp32_ms / int8_ms, int8_res["rmse"] - fp32_res["rmse"],
+           int8_res["delta1"] - fp32_res["delta1"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="FastDepth INT8 with TVM")
+    parser.add_argument("--model-type", default="v2", choices=["v1", "v2"])
+    parser.add_argument("--pth-path",
+                        default="../data/fastdepth/FastDepthV2_L1GN_Best.pth")
+    parser.add_argument("--nyu-root", default="nyudepthv2")
+    parser.add_argument("--calib-split", default="train")
+    parser.add_argument("--calib-samples", type=int, default=100)
+    parser.add_argument("--calibrate-mode",
+                        default="kl_divergence",
+                        choices=["kl_divergence", "percentile", "global_scale"])
+    parser.add_argument("--val-samples", type=int, default=654)
+    # AVX-512 VNNI
+    parser.add_argument("--target", default="llvm -mcpu=cascadelake")
+    parser.add_argument("--export-lib", default=None)
+    main(parser.parse_args())
@@ -0,0 +1,187 @@
+# Bulk ArcFace embedding extraction: decode aligned face crops in a thread
+# pool, run batched inference with an exported library and write the
+# embeddings to a memory-mapped matrix that a killed job resumes from
+import argparse
+import collections
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tvm
+from PIL import Image
+from tvm.contrib import graph_executor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+EMBEDDINGS_FILE = "embeddings.npy"
+IDS_FILE = "ids.txt"
+PROGRESS_FILE = "progress.json"
+
+
+def list_images(source):
+    # `source` is a directory (searched recursively) or a text file with
+    # one image path per line. Ids are paths relative to the directory
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(
+                os.path.relpath(os.path.join(root, f), source)
+                for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+        return source, sorted(paths)
+    with open(source) as f:
+        return "", [line.strip() for line in f if line.strip()]
+
+
+def decode_image(path, image_size, nhwc_uint8):
+    # returns (image, ok), failed images become zeros
+    height, width = image_size
+    try:
+        img = Image.open(path).convert("RGB")
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.BILINEAR)
+        img = np.asarray(img)
+    except (OSError, ValueError) as e:
+        logger.warning(f"fail to decode {path}: {e}")
+        img, ok = np.zeros((height, width, 3), np.uint8), False
+    else:
+        ok = True
+    if nhwc_uint8:
+        return img, ok
+    return img.transpose(2, 0, 1).astype(np.float32), ok
+
+
+def _decode_batch(executor, paths, batch_size, image_size, nhwc_uint8):
+    images = list(
+        executor.map(lambda p: decode_image(p, image_size, nhwc_uint8),
+                     paths))
+    batch = np.stack([img for img, _ in images])
+    if len(batch) < batch_size:
+        batch = np.concatenate([
+            batch,
+            np.zeros((batch_size - len(batch), ) + batch.shape[1:],
+                     batch.dtype)
+        ])
+    return batch, [ok for _, ok in images]
+
+
+def _save_progress(output_dir, progress):
+    # write then rename, so a kill never leaves a truncated file
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(path + ".tmp", path)
+
+
+def extract_embeddings(lib,
+                       source,
+                       output_dir,
+                       input_name="data",
+                       dev=tvm.cpu(0),
+                       num_threads=8,
+                       prefetch=4,
+                       checkpoint_every=50):
+    # the batch size, layout and dtype come from the library input: float32
+    # NCHW, or uint8 NHWC for libraries built with `preprocess`
+    m = graph_executor.GraphModule(lib["default"](dev))
+    input_buf = m.get_input(input_name)
+    batch_size = input_buf.shape[0]
+    nhwc_uint8 = input_buf.dtype == "uint8"
+    image_size = input_buf.shape[1:3] if nhwc_uint8 else input_buf.shape[2:]
+    embedding_dim = m.get_output(0).shape[1]
+
+    os.makedirs(output_dir, exist_ok=True)
+    ids_path = os.path.join(output_dir, IDS_FILE)
+    embeddings_path = os.path.join(output_dir, EMBEDDINGS_FILE)
+    progress_path = os.path.join(output_dir, PROGRESS_FILE)
+    if os.path.exists(progress_path):
+        # resume with the id list of the first run, no directory walk
+        with open(progress_path) as f:
+            progress = json.load(f)
+        with open(ids_path) as f:
+            # older runs wrote a lone newline for an empty source
+            ids = [i for i in f.read().splitlines() if i]
+        root = progress["root"]
+        embeddings = np.lib.format.open_memmap(embeddings_path, mode="r+")
+        logger.info(f"resume from {progress['num_done']}/{len(ids)}")
+    else:
+        root, ids = list_images(source)
+        with open(ids_path, "w") as f:
+            f.write("".join(f"{i}\n" for i in ids))
+        embeddings = np.lib.format.open_memmap(embeddings_path,
+                                               mode="w+",
+                                               dtype=np.float32,
+                                               shape=(len(ids),
+                                                      embedding_dim))
+        progress = {"root": root, "num_done": 0, "failed": []}
+        _save_progress(output_dir, progress)
+
+    starts = range(progress["num_done"], len(ids), batch_size)
+    num_faces, start_time = 0, time.perf_counter()
+    with ThreadPoolExecutor(num_threads) as decoder, \
+            ThreadPoolExecutor(1) as loader:
+        pending = collections.deque()
+
+        def submit(start):
+            paths = [
+                os.path.join(root, i) for i in ids[start:start + batch_size]
+            ]
+            pending.append((start,
+                            loader.submit(_decode_batch, decoder, paths,
+                                          batch_size, image_size,
+                                          nhwc_uint8)))
+
+        for start in starts[:prefetch]:
+            submit(start)
+        for step, start in enumerate(starts):
+            if step + prefetch < len(starts):
+                submit(starts[step + prefetch])
+            _, future = pending.popleft()
+            batch, oks = future.result()
+            m.set_input(input_name, batch)
+            m.run()
+            end = start + len(oks)
+            embeddings[start:end] = m.get_output(0).asnumpy()[:len(oks)]
+            for idx, ok in enumerate(oks):
+                if not ok:
+                    # not the embedding of the blank image fed instead
+                    embeddings[start + idx] = 0
+                    progress["failed"].append(ids[start + idx])
+            progress["num_done"] = end
+            num_faces += len(oks)
+
+            if (step + 1) % checkpoint_every == 0 or end == len(ids):
+                # embeddings hit the disk before the progress that covers
+                # them
+                embeddings.flush()
+                _save_progress(output_dir, progress)
+                logger.info("%d/%d faces, %.1f faces/s" %
+                            (end, len(ids), num_faces /
+                             (time.perf_counter() - start_time)))
+
+    faces_per_s = num_faces / max(time.perf_counter() - start_time, 1e-9)
+    logger.info("extract %d faces (%d failed) at %.1f faces/s" %
+                (num_faces, len(progress["failed"]), faces_per_s))
+    return faces_per_s
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Extract ArcFace embeddings of many face crops")
+    parser.add_argument("source", help="image directory or file list")
+    parser.add_argument("output_dir")
+    parser.add_argument("--lib",
+                        default="lib/cpu_b32.so",
+                        help="library exported with a large batch size")
+    parser.add_argument("--input-name", default="data")
+    parser.add_argument("--num-threads", type=int, default=8)
+    parser.add_argument("--prefetch", type=int, default=4)
+    parser.add_argument("--checkpoint-every", type=int, default=50)
+    args = parser.parse_args()
+    extract_embeddings(tvm.runtime.load_module(args.lib), args.source,
+                       args.output_dir, args.input_name, tvm.cpu(0),
+                       args.num_threads, args.prefetch, args.checkpoint_every)
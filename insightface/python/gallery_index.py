@@ -0,0 +1,334 @@
+# Top-k cosine search over ArcFace embeddings: blocked matrix multiplies
+# with argpartition, plus optional inverted-file (IVF) partitioning
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+EMBEDDINGS_FILE = "embeddings.npy"
+IDS_FILE = "ids.txt"
+IVF_FILE = "ivf.npz"
+META_FILE = "index.json"
+
+
+def l2_normalize(x):
+    x = np.asarray(x, np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def _merge_topk(best_scores, best_rows, scores, rows, k):
+    # keep the k largest of the running top-k and new candidates
+    scores = np.concatenate([best_scores, scores], axis=1)
+    rows = np.concatenate([best_rows, rows], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(rows, top, axis=1)
+    return scores, rows
+
+
+def _block_topk(scores, k):
+    # top-k columns of every row, unsorted
+    if scores.shape[1] <= k:
+        return scores, np.broadcast_to(np.arange(scores.shape[1]),
+                                       scores.shape)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, top, axis=1), top
+
+
+class GalleryIndex:
+    def __init__(self, dim=128, block_size=65536):
+        # rows are L2-normalised, so inner products are cosine similarities.
+        # Removed rows are masked until `compact`
+        self.dim = dim
+        self.block_size = block_size
+        self._embeddings = np.empty((0, dim), np.float32)
+        self.num_rows = 0
+        self.ids = []
+        self.id_to_row = {}
+        self.valid = np.empty(0, bool)
+        self.num_removed = 0
+        self.centroids = None
+        self.lists = None
+
+    def __len__(self):
+        return self.num_rows - self.num_removed
+
+    @property
+    def embeddings(self):
+        return self._embeddings[:self.num_rows]
+
+    def _reserve(self, num_rows):
+        # grow by doubling, a memory-mapped matrix becomes an in-memory
+        # copy on the first add
+        if num_rows <= len(self._embeddings) and \
+                not isinstance(self._embeddings, np.memmap):
+            return
+        capacity = max(num_rows, 2 * len(self._embeddings), 1024)
+        embeddings = np.empty((capacity, self.dim), np.float32)
+        embeddings[:self.num_rows] = self.embeddings
+        self._embeddings = embeddings
+        valid = np.zeros(capacity, bool)
+        valid[:self.num_rows] = self.valid[:self.num_rows]
+        self.valid = valid
+
+    def add(self, ids, embeddings):
+        ids = list(ids)
+        if len(set(ids)) != len(ids) or any(i in self.id_to_row for i in ids):
+            raise ValueError("ids must be unique")
+        embeddings = l2_normalize(embeddings).reshape(-1, self.dim)
+        start = self.num_rows
+        self._reserve(start + len(ids))
+        self._embeddings[start:start + len(ids)] = embeddings
+        self.valid[start:start + len(ids)] = True
+        for offset, id_ in enumerate(ids):
+            self.id_to_row[id_] = start + offset
+        self.ids.extend(ids)
+        self.num_rows += len(ids)
+        if self.centroids is not None:
+            self._assign(np.arange(start, self.num_rows))
+
+    def remove(self, ids):
+        for id_ in ids:
+            row = self.id_to_row.pop(id_)
+            self.valid[row] = False
+            self.num_removed += 1
+        # inverted lists skip removed rows by `valid`
+
+    def compact(self):
+        # drop removed rows, keeps the ivf centroids
+        keep = np.flatnonzero(self.valid[:self.num_rows])
+        ids = [self.ids[row] for row in keep]
+        embeddings = self.embeddings[keep]
+        centroids = self.centroids
+        self.__init__(self.dim, self.block_size)
+        self.add(ids, embeddings)
+        if centroids is not None:
+            self.centroids = centroids
+            self._assign(np.arange(self.num_rows))
+
+    def train_ivf(self, nlist=1024, num_iters=10, num_samples=100000,
+                  seed=0):
+        # spherical k-means on a sample of the gallery, then every row goes
+        # to the inverted list of its nearest centroid
+        rows = np.flatnonzero(self.valid[:self.num_rows])
+        rng = np.random.RandomState(seed)
+        sample = self.embeddings[rng.choice(rows,
+                                            min(num_samples, len(rows)),
+                                            replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(num_iters):
+            assign = self._nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            # re-seed empty lists with random samples
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = l2_normalize(sums)
+        self.centroids = centroids
+        self.lists = [np.empty(0, np.int64) for _ in range(nlist)]
+        self._assign(np.arange(self.num_rows))
+
+    def _nearest_centroid(self, embeddings, centroids=None):
+        centroids = self.centroids if centroids is None else centroids
+        assign = np.empty(len(embeddings), np.int64)
+        for start in range(0, len(embeddings), self.block_size):
+            block = embeddings[start:start + self.block_size]
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T,
+                                                         axis=1)
+        return assign
+
+    def _assign(self, rows):
+        if self.lists is None or len(self.lists) != len(self.centroids):
+            self.lists = [
+                np.empty(0, np.int64) for _ in range(len(self.centroids))
+            ]
+        assign = self._nearest_centroid(self.embeddings[rows])
+        order = np.argsort(assign, kind="stable")
+        lists, starts = np.unique(assign[order], return_index=True)
+        for lst, group in zip(lists, np.split(rows[order], starts[1:])):
+            self.lists[lst] = np.concatenate([self.lists[lst], group])
+
+    def search(self, queries, k=10, nprobe=None, query_block=1024):
+        # returns (scores, ids) of the k most similar rows per query, best
+        # first. With `nprobe` and a trained ivf, only the `nprobe` lists
+        # closest to a query are scanned
+        queries = l2_normalize(queries).reshape(-1, self.dim)
+        scores = np.full((len(queries), k), -np.inf, np.float32)
+        rows = np.full((len(queries), k), -1, np.int64)
+        for start in range(0, len(queries), query_block):
+            q = queries[start:start + query_block]
+            if nprobe is None or self.centroids is None:
+                s, r = self._search_flat(q, k)
+            else:
+                s, r = self._search_ivf(q, k, nprobe)
+            scores[start:start + len(q)] = s
+            rows[start:start + len(q)] = r
+
+        order = np.argsort(-scores, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        # None for missing results, e.g. fewer than k valid rows
+        ids = [[
+            self.ids[r] if r >= 0 and score > -np.inf else None
+            for r, score in zip(row, row_scores)
+        ] for row, row_scores in zip(rows, scores)]
+        return scores, ids
+
+    def _search_flat(self, queries, k):
+        best_scores = np.full((len(queries), 0), -np.inf, np.float32)
+        best_rows = np.full((len(queries), 0), -1, np.int64)
+        for start in range(0, self.num_rows, self.block_size):
+            block = self.embeddings[start:start + self.block_size]
+            scores = queries @ block.T
+            if self.num_removed:
+                scores[:, ~self.valid[start:start + len(block)]] = -np.inf
+            scores, rows = _block_topk(scores, k)
+            best_scores, best_rows = _merge_topk(best_scores, best_rows,
+                                                 scores, rows + start, k)
+        return self._pad(best_scores, best_rows, k)
+
+    def _search_ivf(self, queries, k, nprobe):
+        probes = np.argpartition(-(queries @ self.centroids.T),
+                                 min(nprobe, len(self.centroids)) - 1,
+                                 axis=1)[:, :nprobe]
+        best_scores = np.full((len(queries), k), -np.inf, np.float32)
+        best_rows = np.full((len(queries), k), -1, np.int64)
+        # one matrix multiply per probed list with all queries probing it
+        order = np.argsort(probes.reshape(-1), kind="stable")
+        lists, starts = np.unique(probes.reshape(-1)[order],
+                                  return_index=True)
+        groups = np.split(order // probes.shape[1], starts[1:])
+        for lst, q_idx in zip(lists, groups):
+            list_rows = self.lists[lst]
+            if self.num_removed:
+                list_rows = list_rows[self.valid[list_rows]]
+            if len(list_rows) == 0:
+                continue
+            scores = queries[q_idx] @ self.embeddings[list_rows].T
+            scores, cols = _block_topk(scores, k)
+            best_scores[q_idx], best_rows[q_idx] = _merge_topk(
+                best_scores[q_idx], best_rows[q_idx], scores,
+                list_rows[cols], k)
+        return best_scores, best_rows
+
+    @staticmethod
+    def _pad(scores, rows, k):
+        # fewer than k rows in the gallery
+        if scores.shape[1] < k:
+            pad = k - scores.shape[1]
+            scores = np.pad(scores, ((0, 0), (0, pad)),
+                            constant_values=-np.inf)
+            rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+        return scores, rows
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        if self.num_removed:
+            self.compact()
+        np.save(os.path.join(index_dir, EMBEDDINGS_FILE), self.embeddings)
+        with open(os.path.join(index_dir, IDS_FILE), "w") as f:
+            f.write("".join(f"{i}\n" for i in self.ids))
+        if self.centroids is not None:
+            np.savez(os.path.join(index_dir, IVF_FILE),
+                     centroids=self.centroids,
+                     assign=self._list_assignments())
+        with open(os.path.join(index_dir, META_FILE), "w") as f:
+            json.dump({"dim": self.dim, "num_rows": self.num_rows}, f)
+
+    def _list_assignments(self):
+        assign = np.empty(self.num_rows, np.int64)
+        for lst, rows in enumerate(self.lists):
+            assign[rows] = lst
+        return assign
+
+    @classmethod
+    def load(cls, index_dir, mmap=True, block_size=65536):
+        # with `mmap`, the normalised matrix is mapped read-only and pages
+        # are shared by every process searching the same index
+        with open(os.path.join(index_dir, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(meta["dim"], block_size)
+        index._embeddings = np.load(os.path.join(index_dir, EMBEDDINGS_FILE),
+                                    mmap_mode="r" if mmap else None)
+        index.num_rows = len(index._embeddings)
+        with open(os.path.join(index_dir, IDS_FILE)) as f:
+            index.ids = f.read().splitlines()
+        index.id_to_row = {id_: row for row, id_ in enumerate(index.ids)}
+        index.valid = np.ones(index.num_rows, bool)
+        ivf_path = os.path.join(index_dir, IVF_FILE)
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            index.centroids = ivf["centroids"]
+            order = np.argsort(ivf["assign"], kind="stable")
+            counts = np.bincount(ivf["assign"],
+                                 minlength=len(index.centroids))
+            index.lists = np.split(order, np.cumsum(counts)[:-1])
+        return index
+
+    @classmethod
+    def from_embeddings(cls, embeddings_dir, block_size=65536):
+        # output of `extract_embeddings.py`, zero rows (failed decodes or
+        # not extracted yet) are left out
+        embeddings = np.load(os.path.join(embeddings_dir, EMBEDDINGS_FILE),
+                             mmap_mode="r")
+        with open(os.path.join(embeddings_dir, IDS_FILE)) as f:
+            ids = [i for i in f.read().splitlines() if i]
+        index = cls(embeddings.shape[1], block_size)
+        for start in range(0, len(ids), block_size):
+            block = embeddings[start:start + block_size]
+            valid = np.flatnonzero(np.any(block != 0, axis=1))
+            if len(valid):
+                index.add([ids[start + idx] for idx in valid], block[valid])
+        return index
+
+    def benchmark(self, queries, k=10, nprobes=(1, 4, 16, 64)):
+        # queries/s of brute force and ivf, and recall@k of ivf against the
+        # brute force results
+        start = time.perf_counter()
+        _, exact = self.search(queries, k)
+        res = {"flat": {"qps": len(queries) / (time.perf_counter() - start)}}
+        logger.info("flat: %.1f queries/s" % res["flat"]["qps"])
+        if self.centroids is None:
+            return res
+        for nprobe in nprobes:
+            start = time.perf_counter()
+            _, approx = self.search(queries, k, nprobe)
+            qps = len(queries) / (time.perf_counter() - start)
+            recall = np.mean([
+                len(set(a) & set(e)) / len(e)
+                for a, e in zip(approx, exact)
+            ])
+            res[f"ivf{nprobe}"] = {"qps": qps, "recall": float(recall)}
+            logger.info("ivf nprobe %d: %.1f queries/s, recall@%d %.4f" %
+                        (nprobe, qps, k, recall))
+        return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ArcFace gallery index")
+    parser.add_argument("embeddings_dir",
+                        help="output of extract_embeddings.py")
+    parser.add_argument("--index-dir", default=None)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    index = GalleryIndex.from_embeddings(args.embeddings_dir)
+    if args.nlist > 0:
+        index.train_ivf(args.nlist)
+    if args.index_dir is not None:
+        index.save(args.index_dir)
+    # perturbed gallery rows as probes
+    rng = np.random.RandomState(0)
+    queries = index.embeddings[rng.choice(index.num_rows,
+                                          args.num_queries)]
+    queries = queries + rng.normal(0, 0.05, queries.shape)
+    index.benchmark(queries.astype(np.float32), args.k)
@@ -1,20 +1,57 @@
+import json
 import logging
 import os
+import re
+import tempfile
 from abc import abstractmethod
 
-import mxnet as mx
 import numpy as np
 import tvm
-from tvm import auto_scheduler, relay
 from tvm.contrib import graph_executor
+from tvm.contrib.debugger import debug_executor
+
+from tvm_build_cache import BuildCache
+from tvm_inference_utils import InferenceMixin
+from tvm_params_utils import lib_params, save_params
+from tvm_perf_history import MIN_SAMPLES, PerfHistory
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
 INPUT_NAME = "data"
-
-
-class BaseTvmUtils:
+BUNDLE_MANIFEST = "bundle.json"
+
+
+def _relay_op_names(func_name, op_names):
+    # "tvmgen_default_fused_nn_conv2d_add_nn_relu_1" -> "nn.conv2d+add+nn.relu"
+    name = re.sub(r"^(tvmgen_default_)?fused_", "", func_name)
+    tokens = re.sub(r"(_\d+)+$", "", name).split("_")
+    ops, start = [], 0
+    while start < len(tokens):
+        for end in range(len(tokens), start, -1):
+            candidate = "_".join(tokens[start:end])
+            if candidate in op_names:
+                ops.append(op_names[candidate])
+                start = end
+                break
+        else:
+            ops.append(tokens[start])
+            start += 1
+    return "+".join(ops)
+
+
+def _type_bytes(ttype):
+    from tvm import relay
+
+    if isinstance(ttype, relay.TupleType):
+        return sum(_type_bytes(t) for t in ttype.fields)
+    if not isinstance(ttype, relay.TensorType):
+        return 0
+    return int(np.prod([int(d) for d in ttype.shape])) * \
+        tvm.DataType(ttype.dtype).bits // 8
+
+
+class BaseTvmUtils(InferenceMixin):
     def __init__(self,
                  network_name,
                  image_size,
@@ -22,18 +59,25 @@ class BaseTvmUtils:
                  layout="NHWC",
                  dtype="float32",
                  log_file=None,
-                 lib_path=None):
+                 lib_path=None,
+                 reuse_input_buffers=True,
+                 cache_dir=None,
+                 opt_level=3,
+                 desired_layouts=None):
         # general args
         self.network_name = network_name
         self.batch_size = network_name[0]
         self.image_size = image_size
         self.target = target
         self.layout = layout
+        self.desired_layouts = desired_layouts
         self.dtype = dtype
+        self.opt_level = opt_level
         self.log_file = log_file if log_file is not None \
             else f"{network_name}-{image_size}-{layout}-{target.kind.name}.json"
-
-        self.mod, self.params = self.network_fn()
+        self.reuse_input_buffers = reuse_input_buffers
+        self.input_allocs = 0
+        self.build_cache = BuildCache(cache_dir) if cache_dir else None
 
         if lib_path is not None:
             self.deserialize_lib(lib_path)
@@ -44,29 +88,74 @@ class BaseTvmUtils:
             self._dev = tvm.device(str(self.target), 0)
         return self._dev
 
+    @property
+    def mod(self):
+        # the network (and its frontend framework) is only loaded when
+        # needed, so inference with `lib_path` imports the TVM runtime only
+        if getattr(self, '_mod', None) is None:
+            self._mod, self._params = self.load_network()
+        return self._mod
+
+    @mod.setter
+    def mod(self, mod):
+        self._mod = mod
+
+    @property
+    def params(self):
+        if getattr(self, '_mod', None) is None:
+            self._mod, self._params = self.load_network()
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = params
+
     @property
     def lib(self):
         if getattr(self, '_lib', None) is None:
-            if self.log_file is not None and os.path.exists(self.log_file):
-                with auto_scheduler.ApplyHistoryBest(self.log_file):
-                    with tvm.transform.PassContext(
-                            opt_level=3,
-                            config={"relay.backend.use_auto_scheduler": True}):
-                        self._lib = relay.build(self.mod,
-                                                target=self.target,
-                                                params=self.params)
-                    logger.info(f"load optimized library from {self.log_file}")
-            else:
-                with tvm.transform.PassContext(
-                        opt_level=3,
-                        config={"relay.backend.use_auto_scheduler": True}):
-                    self._lib = relay.build(self.mod,
-                                            target=self.target,
-                                            params=self.params)
-                    logger.info("load unoptimzed library")
-
+            self._lib = self._build_lib()
         return self._lib
 
+    def _build_lib(self):
+        from tvm import auto_scheduler, relay
+
+        use_log = self.log_file is not None and os.path.exists(self.log_file)
+        config = {"relay.backend.use_auto_scheduler": True}
+        cache_key = None
+        if self.build_cache is not None:
+            cache_key = self.build_cache.make_key(
+                self.mod, self.params, self.target, self.opt_level, config,
+                self.log_file if use_log else None)
+            lib = self.build_cache.load(cache_key)
+            if lib is not None:
+                return lib
+
+        if use_log:
+            with auto_scheduler.ApplyHistoryBest(self.log_file):
+                with tvm.transform.PassContext(opt_level=self.opt_level,
+                                               config=config):
+                    lib = relay.build(self.mod,
+                                      target=self.target,
+                                      params=self.params)
+                logger.info(f"load optimized library from {self.log_file}")
+        else:
+            with tvm.transform.PassContext(opt_level=self.opt_level,
+                                           config=config):
+                lib = relay.build(self.mod,
+                                  target=self.target,
+                                  params=self.params)
+                logger.info("load unoptimzed library")
+
+        if cache_key is not None:
+            self.build_cache.store(
+                cache_key, lib, {
+                    "network_name": self.network_name,
+                    "image_size": list(self.image_size),
+                    "target": str(self.target),
+                    "log_file": self.log_file if use_log else None,
+                })
+        return lib
+
     @property
     def module(self):
         if getattr(self, '_module', None) is None:
@@ -79,17 +168,287 @@ class BaseTvmUtils:
         # returns (mod, params)
         pass
 
-    def inference(self, inputs, input_name):
-        data_tvm = tvm.nd.array(inputs)
-        self.module.set_input(input_name, data_tvm)
-        self.module.run()
-        return self.module.get_output(0)
+    def load_network(self):
+        mod, params = self.network_fn()
+        mod = self.convert_layout(mod)
+        if self.dtype != "float32":
+            # float32 graph as the reference of `precision_drift`
+            self.fp32_mod, self.fp32_params = mod, params
+            before = self.precision_report(mod, params)
+            mod, params = self.convert_precision(mod, params)
+            after = self.precision_report(mod, params)
+            logger.info("float32 -> %s: params %.2f -> %.2f MB, "
+                        "op outputs %.2f -> %.2f MB per inference" %
+                        (self.dtype, before[0] / 2**20, after[0] / 2**20,
+                         before[1] / 2**20, after[1] / 2**20))
+        return mod, params
+
+    def convert_precision(self, mod, params):
+        # `dtype` float16 (fp16 storage) or bfloat16: bind params and run
+        # ToMixedPrecision, so weights are folded into reduced precision
+        # constants. Its default op lists keep accumulation-sensitive ops
+        # (reductions, softmax, exp, ...) in float32 and let conv2d/dense
+        # accumulate in float32
+        from tvm import relay
+
+        # work on a copy, the caller's module is the float32 reference
+        mod = tvm.IRModule(mod.functions, mod.type_definitions)
+        mod["main"] = relay.build_module.bind_params_by_name(
+            mod["main"], params)
+        seq = tvm.transform.Sequential([
+            relay.transform.InferType(),
+            relay.transform.SimplifyInference(),
+            relay.transform.FoldConstant(),
+            relay.transform.FoldScaleAxis(),
+            relay.transform.ToMixedPrecision(self.dtype),
+            relay.transform.FoldConstant(),
+        ])
+        with tvm.transform.PassContext(opt_level=3):
+            mod = seq(mod)
+
+        # keep float32 outputs for callers
+        func = mod["main"]
+        if isinstance(func.ret_type, relay.TensorType) \
+                and func.ret_type.dtype != "float32":
+            mod["main"] = relay.Function(func.params,
+                                         relay.cast(func.body, "float32"))
+            mod = relay.transform.InferType()(mod)
+        return mod, {}
+
+    def precision_report(self, mod=None, params=None):
+        # bytes of params/constants and of all op outputs of one inference
+        from tvm import relay
+
+        mod = relay.transform.InferType()(mod or self.mod)
+        params = self.params if params is None else params
+        param_bytes = sum(
+            int(np.prod(v.shape)) * tvm.DataType(v.dtype).bits // 8
+            for v in params.values())
+        activation_bytes = 0
+
+        def visit(expr):
+            nonlocal param_bytes, activation_bytes
+            if isinstance(expr, relay.Constant):
+                param_bytes += _type_bytes(expr.checked_type)
+            elif isinstance(expr, relay.Call):
+                activation_bytes += _type_bytes(expr.checked_type)
+
+        relay.analysis.post_order_visit(mod["main"], visit)
+        return param_bytes, activation_bytes
+
+    def precision_drift(self, inputs, input_name):
+        # compare outputs with the float32 graph, e.g. cosine similarity of
+        # embeddings and max abs error of depth maps
+        from tvm import relay
+
+        if self.dtype == "float32":
+            raise ValueError("precision drift needs a reduced precision dtype")
+        with tvm.transform.PassContext(opt_level=self.opt_level):
+            ref_lib = relay.build(self.fp32_mod,
+                                  target=self.target,
+                                  params=self.fp32_params)
+        m = graph_executor.GraphModule(ref_lib["default"](self.dev))
+        m.set_input(input_name, tvm.nd.array(inputs))
+        m.run()
+        ref = m.get_output(0).asnumpy().astype(np.float64)
+        out = self.inference(inputs, input_name).asnumpy().astype(np.float64)
+
+        ref_rows, out_rows = ref.reshape(len(ref), -1), out.reshape(
+            len(out), -1)
+        cosine = np.sum(ref_rows * out_rows, axis=1) / np.maximum(
+            np.linalg.norm(ref_rows, axis=1) *
+            np.linalg.norm(out_rows, axis=1), 1e-12)
+        res = {
+            "min_cosine": float(np.min(cosine)),
+            "mean_cosine": float(np.mean(cosine)),
+            "max_abs_error": float(np.max(np.abs(out - ref))),
+            "relative_l2_error": float(
+                np.linalg.norm(out - ref) / max(np.linalg.norm(ref), 1e-12)),
+        }
+        logger.info("%s vs float32: cosine min/mean %.6f/%.6f, "
+                    "max abs error %.6f, relative l2 error %.6f" %
+                    (self.dtype, res["min_cosine"], res["mean_cosine"],
+                     res["max_abs_error"], res["relative_l2_error"]))
+        return res
+
+    def convert_layout(self, mod):
+        # frontends generate NCHW graphs, rewrite convs to `self.layout` or
+        # to `self.desired_layouts` ({op name: [data layout, kernel layout]}).
+        # "depthwise_conv2d" is not a relay op: without it depthwise convs
+        # follow the nn.conv2d entry ("default" kernel layout picks HWOI for
+        # NHWC). With a different entry, they are skipped by a first pass
+        # over all convs and converted by a second pass over them only
+        from tvm import relay
+
+        if self.desired_layouts is None and self.layout == "NCHW":
+            return mod
+        desired_layouts = dict(self.desired_layouts or {
+            "nn.conv2d": [self.layout, "default"],
+            "nn.conv2d_transpose": [self.layout, "default"],
+        })
+        depthwise = desired_layouts.pop("depthwise_conv2d", None)
+        if depthwise is not None and \
+                list(depthwise) == list(desired_layouts.get("nn.conv2d", [])):
+            depthwise = None
+        passes = [(desired_layouts, True)]
+        if depthwise is not None:
+            passes.append(({"nn.conv2d": list(depthwise)}, False))
+        for layouts, skip_depthwise in passes:
+            skip_layers = [] if depthwise is None else \
+                self._conv2d_indices(mod, skip_depthwise)
+            seq = tvm.transform.Sequential([
+                relay.transform.RemoveUnusedFunctions(),
+                relay.transform.ConvertLayout(layouts),
+            ])
+            with tvm.transform.PassContext(opt_level=3):
+                with relay.transform.LayoutConfig(skip_layers=skip_layers):
+                    mod = seq(mod)
+            logger.info(f"convert layout with {layouts}, "
+                        f"skip {len(skip_layers)} convs")
+        return mod
+
+    def _conv2d_indices(self, mod, depthwise=True):
+        # indices of depthwise (or all other) convs among nn.conv2d calls
+        # in post order, the order in which ConvertLayout checks
+        # `LayoutConfig`
+        from tvm import relay
+
+        mod = relay.transform.InferType()(mod)
+        convs = []
+
+        def visit(expr):
+            if isinstance(expr, relay.Call) and isinstance(expr.op, tvm.ir.Op) \
+                    and expr.op.name == "nn.conv2d":
+                convs.append(expr)
+
+        relay.analysis.post_order_visit(mod["main"], visit)
+        indices = []
+        for idx, conv in enumerate(convs):
+            kernel_shape = conv.args[1].checked_type.shape
+            in_channels = kernel_shape[conv.attrs.kernel_layout.index("I")]
+            is_depthwise = int(conv.attrs.groups) > 1 and int(in_channels) == 1
+            if is_depthwise == depthwise:
+                indices.append(idx)
+        return indices
+
+    def layout_transform_report(self, number=10, repeat=3):
+        # count layout_transform ops in `self.mod` and estimate their cost
+        # by timing every distinct transform in a graph of its own (an upper
+        # bound, some of them get fused with neighbours in the real graph).
+        # Transforms of params are folded by relay.build and cost nothing
+        from tvm import relay
+
+        mod = relay.transform.InferType()(self.mod)
+        param_names = set(self.params)
+        transforms = {}
+        num_folded = 0
+
+        def visit(expr):
+            nonlocal num_folded
+            if not (isinstance(expr, relay.Call)
+                    and isinstance(expr.op, tvm.ir.Op)
+                    and expr.op.name == "layout_transform"):
+                return
+            arg = expr.args[0]
+            if isinstance(arg, relay.Constant) or \
+                    (isinstance(arg, relay.Var)
+                     and arg.name_hint in param_names):
+                num_folded += 1
+                return
+            ttype = arg.checked_type
+            key = (tuple(int(d) for d in ttype.shape), ttype.dtype,
+                   expr.attrs.src_layout, expr.attrs.dst_layout)
+            transforms[key] = transforms.get(key, 0) + 1
+
+        relay.analysis.post_order_visit(mod["main"], visit)
+
+        records = []
+        for (shape, dtype, src, dst), count in transforms.items():
+            x = relay.var("x", shape=shape, dtype=dtype)
+            func = relay.Function([x], relay.layout_transform(x, src, dst))
+            with tvm.transform.PassContext(opt_level=3):
+                lib = relay.build(tvm.IRModule.from_expr(func),
+                                  target=self.target)
+            m = graph_executor.GraphModule(lib["default"](self.dev))
+            m.set_input("x", np.random.uniform(size=shape).astype(dtype))
+            ftimer = m.module.time_evaluator("run",
+                                             self.dev,
+                                             number=number,
+                                             repeat=repeat)
+            cost_ms = np.mean(ftimer().results) * 1e3
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            records.append({
+                "shape": shape,
+                "dtype": dtype,
+                "src_layout": src,
+                "dst_layout": dst,
+                "count": count,
+                "bytes": nbytes * count,
+                "cost_ms": cost_ms * count,
+            })
+            logger.info("layout_transform %s %s->%s x%d: %.3f ms" %
+                        (shape, src, dst, count, cost_ms * count))
+        logger.info(
+            "%d runtime layout_transform ops, %.3f ms in total; "
+            "%d folded params transforms" %
+            (sum(r["count"] for r in records),
+             sum(r["cost_ms"] for r in records), num_folded))
+        return records
+
+    def _tuned_status(self, tasks):
+        # number of records and best latency (ms) of every task in log_file
+        from tvm import auto_scheduler
+
+        counts = [0] * len(tasks)
+        best_ms = [float("inf")] * len(tasks)
+        if not tasks or self.log_file is None \
+                or not os.path.exists(self.log_file):
+            return counts, best_ms
+        str_target = str(tasks[0].target)
+        key_to_idx = {task.workload_key: i for i, task in enumerate(tasks)}
+        for inp, res in auto_scheduler.load_records(self.log_file):
+            idx = key_to_idx.get(inp.task.workload_key)
+            if idx is None or str(inp.task.target) != str_target:
+                continue
+            counts[idx] += 1
+            if res.error_no == 0:
+                cost = np.mean([c.value for c in res.costs]) * 1e3
+                best_ms[idx] = min(best_ms[idx], cost)
+        return counts, best_ms
+
+    def _select_tasks(self, tasks, task_weights, min_trials_per_task,
+                      target_latency_ms):
+        # drop tasks that already meet the trial or latency target
+        counts, best_ms = self._tuned_status(tasks)
+        selected = [
+            idx for idx in range(len(tasks))
+            if not (min_trials_per_task is not None
+                    and counts[idx] >= min_trials_per_task) and not (
+                        target_latency_ms is not None
+                        and best_ms[idx] <= target_latency_ms)
+        ]
+        logger.info(
+            "Resume from %s: reuse %d existing trials, skip %d/%d tasks" %
+            (self.log_file, sum(counts), len(tasks) - len(selected),
+             len(tasks)))
+        return [tasks[idx] for idx in selected], \
+            [task_weights[idx] for idx in selected]
 
     def local_auto_scheduler(self,
                              repeat=1,
                              min_repeat_ms=300,
                              timeout=10,
-                             num_measure_trials=200):
+                             num_measure_trials=200,
+                             resume=True,
+                             min_trials_per_task=None,
+                             target_latency_ms=None,
+                             num_measure_servers=1,
+                             cores_per_server=None,
+                             build_workers=None,
+                             build_cores=None):
+        from tvm import auto_scheduler
+        from tvm_tuning_utils import MeasureThroughput, ParallelMeasureContext
+
         # extract tasks
         tasks, task_weights = auto_scheduler.extract_tasks(
             self.mod["main"], self.params, self.target)
@@ -98,30 +457,55 @@ class BaseTvmUtils:
                          (idx, task.workload_key))
             logger.debug(task.compute_dag)
 
+        # with `resume`, records in log_file warm start the cost model and
+        # search policy, and `num_measure_trials` new trials only go to
+        # under-tuned tasks
+        load_log_file = None
+        if resume and self.log_file is not None \
+                and os.path.exists(self.log_file):
+            load_log_file = self.log_file
+            tasks, task_weights = self._select_tasks(tasks, task_weights,
+                                                     min_trials_per_task,
+                                                     target_latency_ms)
+            if not tasks:
+                logger.info("All tasks are tuned, skip tuning")
+                self._lib = self._build_lib()
+                return
+
         # generate tuner
-        tuner = auto_scheduler.TaskScheduler(tasks, task_weights)
+        tuner = auto_scheduler.TaskScheduler(tasks,
+                                             task_weights,
+                                             load_log_file=load_log_file)
 
         logging.info("Begin tuning...")
-        measure_ctx = auto_scheduler.LocalRPCMeasureContext(
-            repeat=repeat, min_repeat_ms=min_repeat_ms, timeout=timeout)
-        tune_option = auto_scheduler.TuningOptions(
-            num_measure_trials=num_measure_trials,
-            runner=measure_ctx.runner,
-            measure_callbacks=[auto_scheduler.RecordToFile(self.log_file)],
-        )
-        tuner.tune(tune_option)
+        # build candidates with `build_workers` processes (one per core left
+        # over by default) and measure them on `num_measure_servers` local servers
+        # pinned to disjoint core sets
+        throughput = MeasureThroughput()
+        with ParallelMeasureContext(num_measure_servers,
+                                    cores_per_server,
+                                    build_workers,
+                                    build_cores,
+                                    repeat=repeat,
+                                    min_repeat_ms=min_repeat_ms,
+                                    timeout=timeout) as measure_ctx:
+            tune_option = auto_scheduler.TuningOptions(
+                num_measure_trials=num_measure_trials,
+                builder=measure_ctx.builder,
+                runner=measure_ctx.runner,
+                measure_callbacks=[
+                    auto_scheduler.RecordToFile(self.log_file), throughput
+                ],
+            )
+            tuner.tune(tune_option)
+        throughput.report()
 
         # update self.lib
-        with auto_scheduler.ApplyHistoryBest(self.log_file):
-            with tvm.transform.PassContext(
-                    opt_level=3,
-                    config={"relay.backend.use_auto_scheduler": True}):
-                self._lib = relay.build(self.mod,
-                                        target=self.target,
-                                        params=self.params)
-            logger.info(f"load optimized library from {self.log_file}")
+        self._lib = self._build_lib()
 
     def remote_auto_scheduler(self, device_key, rpc_host, rpc_port):
+        from tvm import auto_scheduler
+
         # generate tasks
         tasks, task_weights = auto_scheduler.extract_tasks(
             self.mod["main"], self.params, self.target)
@@ -150,23 +534,76 @@ class BaseTvmUtils:
         tuner.tune(tune_option)
 
         # update self.lib
-        with auto_scheduler.ApplyHistoryBest(self.log_file):
-            with tvm.transform.PassContext(
-                    opt_level=3,
-                    config={"relay.backend.use_auto_scheduler": True}):
-                self._lib = relay.build(self.mod,
-                                        target=self.target,
-                                        params=self.params)
-            logger.info(f"load optimized library from {self.log_file}")
-
-    def export_lib(self, lib_path):
-        self.lib.export_library(lib_path)
+        self._lib = self._build_lib()
+
+    def export_lib(self, lib_path, params_path=None):
+        # with `params_path`, params go to a page-aligned file instead of
+        # being baked into the library, see `TvmDeployementTool(params_path)`
+        if params_path is None:
+            self.lib.export_library(lib_path)
+            return
+        params = lib_params(self.lib)
+        if params is None:
+            # loaded library of a runtime without `get_graph_params`, rebuild
+            # it from the network
+            build_cache, self.build_cache = self.build_cache, None
+            try:
+                self._lib, self._module = self._build_lib(), None
+            finally:
+                self.build_cache = build_cache
+            params = self.lib.get_params()
+        save_params(params, params_path)
+        self.lib['remove_params']().export_library(lib_path)
+
+    def export_batch_bundle(self,
+                            bundle_dir,
+                            batch_sizes=(1, 2, 4, 8, 16, 32),
+                            auto_tune=False,
+                            **tune_kwargs):
+        # TVM only builds static shapes, so build (and optionally tune) one
+        # library per batch bucket and describe them in a manifest.
+        # `network_fn` must build the graph with `self.image_size`.
+        os.makedirs(bundle_dir, exist_ok=True)
+        states = (self.image_size, self.log_file, getattr(self, '_mod', None),
+                  getattr(self, '_params', None), getattr(self, '_lib', None),
+                  getattr(self, '_module', None))
+        log_root, log_ext = os.path.splitext(self.log_file)
+        libs = {}
+        try:
+            for batch_size in sorted(set(batch_sizes)):
+                self.image_size = (batch_size, ) + tuple(states[0][1:])
+                self.log_file = f"{log_root}-batch{batch_size}{log_ext}"
+                self.mod, self.params = self.load_network()
+                self._lib, self._module = None, None
+                if auto_tune:
+                    self.local_auto_scheduler(**tune_kwargs)
+                lib_name = f"batch{batch_size}.so"
+                self.export_lib(os.path.join(bundle_dir, lib_name))
+                libs[str(batch_size)] = lib_name
+                logger.info(f"export batch {batch_size} library {lib_name}")
+        finally:
+            (self.image_size, self.log_file, self._mod, self._params,
+             self._lib, self._module) = states
+
+        manifest = {
+            "network_name": self.network_name,
+            "image_size": list(self.image_size[1:]),
+            "target": str(self.target),
+            "libs": libs,
+        }
+        with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
 
     def deserialize_lib(self, lib_path):
         self._lib = tvm.runtime.load_module(lib_path)
 
-    def evaluate(self, repeat=3, min_repeat_ms=500):
+    def evaluate(self, repeat=3, min_repeat_ms=500, history=None):
+        # with `history` (a jsonl path), results are appended to the
+        # performance history, see `python/tvm_perf_history.py`, with at
+        # least `MIN_SAMPLES` repeats for significant comparisons
         logger.info("Evaluate inference time cost...")
+        if history is not None:
+            repeat = max(repeat, MIN_SAMPLES)
         ftimer = self.module.module.time_evaluator("run",
                                                    self.dev,
                                                    repeat=repeat,
@@ -174,6 +611,98 @@ class BaseTvmUtils:
         prof_res = np.array(ftimer().results) * 1e3  # convert to millisecond
         logger.info("Mean inference time (std dev): %.2f ms (%.2f ms)" %
                     (np.mean(prof_res), np.std(prof_res)))
+        if history is not None:
+            PerfHistory(history).append(self.network_name,
+                                        self.target,
+                                        prof_res,
+                                        config={
+                                            "image_size": list(
+                                                self.image_size),
+                                            "layout": self.layout,
+                                            "dtype": self.dtype,
+                                            "opt_level": self.opt_level,
+                                        },
+                                        log_file=self.log_file,
+                                        lib=self.lib)
+        return prof_res
+
+    def profile(self, inputs, input_name, number=10, chrome_trace=None,
+                top=20):
+        # per fused op latency with the debug executor, ranked by share of
+        # the total time. Returns one record per fused function
+        lib = self.lib
+        if not hasattr(lib, "get_graph_json"):
+            # cached or deserialized libraries have no graph json
+            build_cache, self.build_cache = self.build_cache, None
+            try:
+                lib = self._build_lib()
+            finally:
+                self.build_cache = build_cache
+        graph_json = lib.get_graph_json()
+        with tempfile.TemporaryDirectory() as dump_root:
+            m = debug_executor.create(graph_json,
+                                      lib.get_lib(),
+                                      self.dev,
+                                      dump_root=dump_root)
+            m.set_input(**lib.get_params())
+            m.set_input(input_name, tvm.nd.array(inputs))
+            node_times = m.run_individual(number=number, repeat=1)
+        # seconds per node, older TVM returns strings, newer one returns
+        # one value per repeat
+        node_times = np.asarray(node_times, dtype=float)
+        node_times = node_times.reshape(len(node_times), -1).mean(axis=1)
+
+        op_names = {
+            op.replace(".", "_"): op
+            for op in tvm.get_global_func("ir.ListOpNames")()
+        }
+        nodes = json.loads(graph_json)["nodes"]
+        records, events, ts = {}, [], 0.
+        for idx, node in enumerate(nodes):
+            if node["op"] != "tvm_op":
+                continue
+            func_name = node["attrs"]["func_name"]
+            if func_name not in records:
+                records[func_name] = {
+                    "func_name": func_name,
+                    "relay_ops": _relay_op_names(func_name, op_names),
+                    "calls": 0,
+                    "total_ms": 0.,
+                }
+            records[func_name]["calls"] += 1
+            records[func_name]["total_ms"] += node_times[idx] * 1e3
+            events.append({
+                "name": node["name"],
+                "cat": records[func_name]["relay_ops"],
+                "ph": "X",
+                "ts": ts,
+                "dur": node_times[idx] * 1e6,
+                "pid": 0,
+                "tid": 0,
+                "args": {
+                    "func_name": func_name
+                },
+            })
+            ts += node_times[idx] * 1e6
+
+        total_ms = sum(r["total_ms"] for r in records.values())
+        records = sorted(records.values(), key=lambda r: -r["total_ms"])
+        for r in records:
+            r["share"] = r["total_ms"] / max(total_ms, 1e-12)
+        logger.info("Profile of %d fused ops, %.3f ms in total" %
+                    (len(records), total_ms))
+        logger.info("%4s %8s %6s %5s  %s" %
+                    ("rank", "ms", "share", "calls", "relay ops (fused func)"))
+        for rank, r in enumerate(records[:top]):
+            logger.info("%4d %8.3f %5.1f%% %5d  %s (%s)" %
+                        (rank, r["total_ms"], r["share"] * 100, r["calls"],
+                         r["relay_ops"], r["func_name"]))
+
+        if chrome_trace is not None:
+            with open(chrome_trace, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            logger.info(f"write chrome trace to {chrome_trace}")
+        return records
 
 
 class ArcFaceUtils(BaseTvmUtils):
@@ -185,18 +714,34 @@ class ArcFaceUtils(BaseTvmUtils):
                  target,
                  layout="NHWC",
                  dtype="float32",
-                 log_file=None):
+                 log_file=None,
+                 lib_path=None,
+                 cache_dir=None,
+                 opt_level=3,
+                 desired_layouts=None):
         self.model_prefix = model_prefix
         self.epoch = epoch
-        super().__init__(network_name, image_size, target, layout, dtype,
-                         log_file)
+        super().__init__(network_name,
+                         image_size,
+                         target,
+                         layout,
+                         dtype,
+                         log_file,
+                         lib_path,
+                         cache_dir=cache_dir,
+                         opt_level=opt_level,
+                         desired_layouts=desired_layouts)
 
     def network_fn(self):
         # returns (mod, params)
+        import mxnet as mx
+        from tvm import relay
+
         shape_dict = {"data": self.image_size}
         sym, arg_params, aux_params = mx.model.load_checkpoint(
             self.model_prefix, self.epoch)
-        mod, params = relay.frontend.from_mxnet(sym, shape_dict, self.dtype,
+        # import in float32, `load_network` converts to `self.dtype`
+        mod, params = relay.frontend.from_mxnet(sym, shape_dict, "float32",
                                                 arg_params, aux_params)
         return mod, params
 
@@ -205,7 +750,10 @@ def _test_with_mxnet(inputs,
                      model_prefix,
                      epoch,
                      image_size=(1, 3, 112, 112),
-                     ctx=mx.gpu(0)):
+                     ctx=None):
+    import mxnet as mx
+
+    ctx = mx.gpu(0) if ctx is None else ctx
     sym, arg_params, aux_params = mx.model.load_checkpoint(model_prefix, epoch)
     model = mx.mod.Module(symbol=sym, context=ctx, label_names=None)
     model.bind(data_shapes=[(INPUT_NAME, image_size)])
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import tvm
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+LIB_NAME = "lib.so"
+META_NAME = "meta.json"
+LOG_NAME = "cache.log"
+
+
+class BuildCache:
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        # exported libraries keyed by everything that affects relay.build,
+        # see `make_key`. Least recently used entries are evicted once the
+        # cache gets larger than `max_bytes`
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(mod, params, target, opt_level, config, log_file=None):
+        sha = hashlib.sha256()
+        sha.update(tvm.__version__.encode())
+        sha.update(mod.astext(show_meta_data=True).encode())
+        params = params or {}
+        sha.update(
+            tvm.runtime.save_param_dict(
+                {name: params[name]
+                 for name in sorted(params)}))
+        sha.update(str(target).encode())
+        pass_config = {"opt_level": opt_level, "config": config}
+        sha.update(
+            json.dumps(pass_config, sort_keys=True, default=str).encode())
+        if log_file is not None and os.path.exists(log_file):
+            with open(log_file, "rb") as f:
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    def load(self, key):
+        lib_path = os.path.join(self.cache_dir, key, LIB_NAME)
+        if not os.path.exists(lib_path):
+            self._log("miss", key)
+            return None
+        # mtime of meta file is the LRU timestamp
+        os.utime(os.path.join(self.cache_dir, key, META_NAME))
+        self._log("hit", key)
+        return tvm.runtime.load_module(lib_path)
+
+    def store(self, key, lib, meta=None):
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        lib.export_library(os.path.join(tmp_dir, LIB_NAME))
+        with open(os.path.join(tmp_dir, META_NAME), "w") as f:
+            json.dump(dict(meta or {}, key=key, created=time.time()),
+                      f,
+                      indent=2)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._log("store", key, f"{self._entry_bytes(entry_dir)} bytes")
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self.cache_dir, key, META_NAME)
+            if not os.path.exists(meta_path):
+                continue
+            entries.append((os.path.getmtime(meta_path), key,
+                            self._entry_bytes(os.path.join(self.cache_dir,
+                                                           key))))
+        total_bytes = sum(e[2] for e in entries)
+        for _, key, num_bytes in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key),
+                          ignore_errors=True)
+            total_bytes -= num_bytes
+            self._log("evict", key, f"{num_bytes} bytes")
+
+    def _entry_bytes(self, entry_dir):
+        return sum(
+            os.path.getsize(os.path.join(entry_dir, f))
+            for f in os.listdir(entry_dir))
+
+    def _log(self, event, key, info=""):
+        logger.info(f"build cache {event}: {key} {info}")
+        with open(os.path.join(self.cache_dir, LOG_NAME), "a") as f:
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{event}\t{key}"
+                    f"\t{info}\n")
@@ -0,0 +1,119 @@
+import ctypes
+import logging
+import time
+
+import numpy as np
+import tvm
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+
+def numpy_view(arr):
+    # numpy array sharing memory with a host NDArray, no copy
+    nbytes = int(np.prod(arr.shape)) * np.dtype(arr.dtype).itemsize
+    ptr = arr.handle.contents.data + arr.handle.contents.byte_offset
+    return np.frombuffer((ctypes.c_char * nbytes).from_address(ptr),
+                         arr.dtype).reshape(arr.shape)
+
+
+class InferenceMixin:
+    # preallocated input/output buffers of `inference` and its timing,
+    # shared by the development and deployment tools. Needs `self.dev`,
+    # `self.module`, `self.reuse_input_buffers` and `self.input_allocs`
+
+    def _set_input(self, module, input_name, inputs):
+        # copy into one preallocated NDArray per module/input instead of
+        # allocating a new one with `tvm.nd.array` on every call. Once bound
+        # zero-copy, the executor only reads from that buffer, so every
+        # input of the module/input pair goes through it
+        if not self.reuse_input_buffers:
+            self.input_allocs += 1
+            module.set_input(input_name, tvm.nd.array(inputs))
+            return
+        if getattr(self, '_input_buffers', None) is None:
+            self._input_buffers = {}
+        key = (id(module), input_name)
+        owner, buf, zero_copy = self._input_buffers.get(key, (None, ) * 3)
+        if not isinstance(inputs, (np.ndarray, tvm.nd.NDArray)):
+            # lists, torch tensors, ... in the dtype of the bound buffer
+            inputs = np.asarray(inputs,
+                                buf.dtype if owner is module else None)
+        if owner is not module or buf.shape != inputs.shape \
+                or buf.dtype != str(inputs.dtype):
+            buf = tvm.nd.empty(inputs.shape, str(inputs.dtype), self.dev)
+            self.input_allocs += 1
+            try:
+                # the executor reads from `buf` directly afterwards
+                module.module["set_input_zero_copy"](input_name, buf)
+                zero_copy = True
+            except (AttributeError, tvm.TVMError):
+                zero_copy = False
+            self._input_buffers[key] = (module, buf, zero_copy)
+        buf.copyfrom(inputs)
+        if not zero_copy:
+            module.set_input(input_name, buf)
+
+    def _output_buffer(self, module, index):
+        # one preallocated host NDArray per module/output, `get_output`
+        # copies into it (from any device) and `view` shares its memory
+        if getattr(self, '_output_buffers', None) is None:
+            self._output_buffers = {}
+        key = (id(module), index)
+        owner, buf, view = self._output_buffers.get(key, (None, ) * 3)
+        if owner is not module:
+            output = module.get_output(index)
+            buf = tvm.nd.empty(output.shape, output.dtype, tvm.cpu(0))
+            view = numpy_view(buf)
+            self._output_buffers[key] = (module, buf, view)
+        return buf, view
+
+    def register_output_buffers(self):
+        for index in range(self.module.get_num_outputs()):
+            self._output_buffer(self.module, index)
+
+    def _get_output(self, module, index, out=None):
+        # `out` could be None (new NDArray), an NDArray or a numpy array
+        if out is None:
+            return module.get_output(index)
+        if isinstance(out, tvm.nd.NDArray):
+            return module.get_output(index, out)
+        buf, view = self._output_buffer(module, index)
+        module.get_output(index, buf)
+        np.copyto(out, view)
+        return out
+
+    def inference(self, inputs, input_name, out=None):
+        self._set_input(self.module, input_name, inputs)
+        self.module.run()
+        return self._get_output(self.module, 0, out)
+
+    def inference_outputs(self, inputs, input_name, copy=False):
+        # all outputs as numpy arrays. Without `copy`, they are views of the
+        # registered output buffers and only valid until the next call
+        self._set_input(self.module, input_name, inputs)
+        self.module.run()
+        outputs = []
+        for index in range(self.module.get_num_outputs()):
+            buf, view = self._output_buffer(self.module, index)
+            self.module.get_output(index, buf)
+            outputs.append(view.copy() if copy else view)
+        return outputs
+
+    def evaluate_inference(self, inputs, input_name, number=100, repeat=3):
+        # unlike `evaluate`, also time the python side of `inference`
+        logger.info("Evaluate python inference time cost...")
+        self.inference(inputs, input_name)
+        input_allocs = self.input_allocs
+        prof_res = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                self.inference(inputs, input_name)
+            self.dev.sync()
+            prof_res.append((time.perf_counter() - start) / number)
+        prof_res = np.array(prof_res) * 1e3  # convert to millisecond
+        logger.info("Mean inference time (std dev): %.2f ms (%.2f ms), "
+                    "input allocations per call: %.2f" %
+                    (np.mean(prof_res), np.std(prof_res),
+                     (self.input_allocs - input_allocs) / (number * repeat)))
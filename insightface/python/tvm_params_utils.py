@@ -0,0 +1,115 @@
+import json
+import logging
+import struct
+
+import numpy as np
+import tvm
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+PARAMS_MAGIC = b"TVMPARAM"
+PARAMS_ALIGNMENT = 4096
+
+
+def _align(offset, alignment=PARAMS_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def lib_params(lib):
+    # params of a library from `relay.build`, or of a `runtime.Module`
+    # loaded from an exported one (build cache, `deserialize_lib`). None if
+    # the runtime can't return them
+    if hasattr(lib, "get_params"):
+        return lib.get_params()
+    try:
+        return dict(lib["get_graph_params"]())
+    except (AttributeError, tvm.TVMError):
+        return None
+
+
+def save_params(params, params_path):
+    # layout: magic, header length (uint64), json header, then every param
+    # at a page-aligned offset so that it can be memory-mapped in place
+    arrays = {
+        name: np.ascontiguousarray(
+            v.asnumpy() if isinstance(v, tvm.nd.NDArray) else v)
+        for name, v in params.items()
+    }
+    entries = []
+    offset = 0
+    for name, arr in arrays.items():
+        entries.append({
+            "name": name,
+            "dtype": str(arr.dtype),
+            "shape": list(arr.shape),
+            "offset": offset,
+            "nbytes": arr.nbytes,
+        })
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps({
+        "alignment": PARAMS_ALIGNMENT,
+        "params": entries
+    }).encode()
+    data_start = _align(len(PARAMS_MAGIC) + 8 + len(header))
+
+    with open(params_path, "wb") as f:
+        f.write(PARAMS_MAGIC + struct.pack("<Q", len(header)) + header)
+        for entry, arr in zip(entries, arrays.values()):
+            f.seek(data_start + entry["offset"])
+            f.write(arr.tobytes())
+        f.truncate(data_start + offset)
+    logger.info(f"save {len(entries)} params ({offset / 2**20:.2f} MB) "
+                f"to {params_path}")
+
+
+def load_params(params_path):
+    # numpy views of a copy-on-write mapping: pages come from the page
+    # cache and are shared by every process mapping the same file as long
+    # as nobody writes to them (DLPack can't export read-only arrays)
+    mm = np.memmap(params_path, np.uint8, mode="c")
+    if mm[:len(PARAMS_MAGIC)].tobytes() != PARAMS_MAGIC:
+        raise ValueError(f"{params_path} is not a params file")
+    header_len, = struct.unpack("<Q", mm[len(PARAMS_MAGIC):16].tobytes())
+    header = json.loads(mm[16:16 + header_len].tobytes())
+    data_start = _align(16 + header_len, header["alignment"])
+    params = {}
+    for entry in header["params"]:
+        start = data_start + entry["offset"]
+        params[entry["name"]] = mm[start:start + entry["nbytes"]].view(
+            entry["dtype"]).reshape(entry["shape"])
+    return params
+
+
+def bind_params(module, params, dev):
+    # zero copy on cpu: the executor reads weights from the mapped pages.
+    # Other devices get a private device copy
+    zero_copy = dev.device_type == tvm.cpu(0).device_type
+    for name, arr in params.items():
+        if zero_copy:
+            module.module["set_input_zero_copy"](
+                name, tvm.nd.from_dlpack(arr.__dlpack__()))
+        else:
+            module.set_input(name, arr)
+    return zero_copy
+
+
+def memory_usage():
+    # MB of resident memory of the current process, split into private
+    # (RssAnon) and file-backed (RssFile) pages. Pss charges shared pages
+    # to every process mapping them proportionally
+    res = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key = line.split(":")[0]
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                res[key] = int(line.split()[1]) / 1024
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    res["Pss"] = int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return res
+
@@ -0,0 +1,241 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+# samples per record, fewer can't reach the default `alpha` of `compare`
+# (3 against 3 samples give p-values of 0.04 at best)
+MIN_SAMPLES = 10
+
+
+def host_cpu():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except FileNotFoundError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def file_hash(path):
+    if path is None or not os.path.exists(path):
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def lib_hash(lib, params=None):
+    # hash of a library's graph json and params, the same for a library
+    # from `relay.build`, loaded from the build cache or an exported file.
+    # `params` (name -> NDArray or numpy array) are the ones bound at run
+    # time, e.g. from `load_params` for a library exported without them.
+    # None if the runtime can't return the graph
+    import tvm
+
+    try:
+        if hasattr(lib, "get_graph_json"):
+            graph_json = lib.get_graph_json()
+            params = lib.get_params() if params is None else params
+        else:
+            graph_json = lib["get_graph_json"]()
+            if params is None:
+                params = dict(lib["get_graph_params"]())
+    except (AttributeError, tvm.TVMError):
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    h.update(graph_json.encode())
+    for name in sorted(params):
+        value = params[name]
+        if isinstance(value, tvm.nd.NDArray):
+            value = value.asnumpy()
+        value = np.ascontiguousarray(value)
+        h.update(f"{name}:{value.dtype}:{value.shape}".encode())
+        h.update(memoryview(value).cast("B"))
+    return h.hexdigest()
+
+
+def latency_summary(samples_ms):
+    return {
+        "mean_ms": float(np.mean(samples_ms)),
+        "std_ms": float(np.std(samples_ms)),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p99_ms": float(np.percentile(samples_ms, 99)),
+    }
+
+
+def mann_whitney_u(x, y):
+    # one-sided p-value of `x` being stochastically greater than `y`, normal
+    # approximation with tie and continuity correction
+    x, y = np.asarray(x, np.float64), np.asarray(y, np.float64)
+    n1, n2 = len(x), len(y)
+    values = np.concatenate([x, y])
+    _, inverse, counts = np.unique(values,
+                                   return_inverse=True,
+                                   return_counts=True)
+    # average ranks of tied values
+    ranks = (np.cumsum(counts) - (counts - 1) / 2.)[inverse]
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2.
+    n = n1 + n2
+    tie = np.sum(counts**3 - counts) / (n * (n - 1))
+    sigma = math.sqrt(n1 * n2 / 12. * ((n + 1) - tie))
+    if sigma == 0:
+        return 1.0
+    z = (u - n1 * n2 / 2. - 0.5) / sigma
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def min_p_value(n1, n2):
+    # smallest p-value of `mann_whitney_u` with `n1` and `n2` samples
+    return mann_whitney_u(np.arange(n1) + n2, np.arange(n2))
+
+
+class PerfHistory:
+    def __init__(self, path):
+        # one json record per line, the baselines live in `<path>.baseline`
+        self.path = path
+        self.baseline_path = path + ".baseline"
+
+    @staticmethod
+    def key(record):
+        return "%s|%s|%s" % (record["model"], record["target"],
+                             json.dumps(record.get("config", {}),
+                                        sort_keys=True))
+
+    def append(self,
+               model,
+               target,
+               samples_ms,
+               config=None,
+               log_file=None,
+               lib=None,
+               params=None):
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "model": model,
+            "target": str(target),
+            "config": config or {},
+            "host_cpu": host_cpu(),
+            "log_hash": file_hash(log_file),
+            "lib_hash": lib_hash(lib, params) if lib is not None else None,
+            "samples_ms": [float(s) for s in samples_ms],
+        }
+        record.update(latency_summary(samples_ms))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def latest(self):
+        # newest record per model/target/config
+        res = {}
+        for record in self.records():
+            res[self.key(record)] = record
+        return res
+
+    def baselines(self):
+        if not os.path.exists(self.baseline_path):
+            return {}
+        with open(self.baseline_path) as f:
+            return json.load(f)
+
+    def set_baseline(self, model=None):
+        # newest records (of `model`) become the baselines
+        baselines = self.baselines()
+        for key, record in self.latest().items():
+            if model is None or record["model"] == model:
+                baselines[key] = record
+        with open(self.baseline_path, "w") as f:
+            json.dump(baselines, f, indent=2)
+        return baselines
+
+    def compare(self, alpha=0.01, threshold=0.05):
+        # a regression is a significantly slower (Mann-Whitney U, one
+        # sided) newest record whose median is `threshold` above baseline
+        regressions = []
+        latest = self.latest()
+        for key, base in self.baselines().items():
+            record = latest.get(key)
+            if record is None or record == base:
+                continue
+            num_samples = (len(record["samples_ms"]), len(base["samples_ms"]))
+            if min_p_value(*num_samples) >= alpha:
+                logger.warning(f"{key}: {num_samples[0]} against "
+                               f"{num_samples[1]} samples can't reach "
+                               f"p-value {alpha}, record at least "
+                               f"{MIN_SAMPLES} samples")
+            p_value = mann_whitney_u(record["samples_ms"], base["samples_ms"])
+            change = record["p50_ms"] / base["p50_ms"] - 1
+            regressed = p_value < alpha and change > threshold
+            if record["host_cpu"] != base["host_cpu"]:
+                logger.warning(f"{key}: host cpu changed from "
+                               f"{base['host_cpu']} to {record['host_cpu']}")
+            logger.log(
+                logging.ERROR if regressed else logging.INFO,
+                "%s: p50 %.3f -> %.3f ms (%+.1f%%), p-value %.4f%s" %
+                (key, base["p50_ms"], record["p50_ms"], change * 100,
+                 p_value, ", REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append({
+                    "key": key,
+                    "change": change,
+                    "p_value": p_value,
+                    "log_hash": (base["log_hash"], record["log_hash"]),
+                    "lib_hash": (base["lib_hash"], record["lib_hash"]),
+                })
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TVM performance history")
+    parser.add_argument("history", help="jsonl file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    baseline = subparsers.add_parser(
+        "baseline", help="mark the newest records as baselines")
+    baseline.add_argument("--model", default=None)
+    compare = subparsers.add_parser(
+        "compare", help="exit 1 on latency regressions against baselines")
+    compare.add_argument("--alpha", type=float, default=0.01)
+    compare.add_argument("--threshold",
+                         type=float,
+                         default=0.05,
+                         help="minimum relative p50 increase")
+    subparsers.add_parser("show", help="print the newest records")
+    args = parser.parse_args()
+
+    history = PerfHistory(args.history)
+    if args.command == "baseline":
+        logger.info(f"{len(history.set_baseline(args.model))} baselines")
+    elif args.command == "compare":
+        regressions = history.compare(args.alpha, args.threshold)
+        sys.exit(1 if regressions else 0)
+    else:
+        for key, record in history.latest().items():
+            print("%s %s: p50 %.3f ms, p99 %.3f ms, log %s, lib %s" %
+                  (record["time"], key, record["p50_ms"], record["p99_ms"],
+                   record["log_hash"], record["lib_hash"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import logging
+import os
+import time
+
+from tvm import auto_scheduler
+from tvm.auto_scheduler.measure import PythonBasedMeasureCallback
+from tvm.rpc.server import Server
+from tvm.rpc.tracker import Tracker
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+
+class ParallelMeasureContext:
+    def __init__(self,
+                 num_servers=1,
+                 cores_per_server=None,
+                 build_workers=None,
+                 build_cores=None,
+                 repeat=1,
+                 min_repeat_ms=300,
+                 timeout=10,
+                 enable_cpu_cache_flush=False):
+        # like `auto_scheduler.LocalRPCMeasureContext`, but with several
+        # local rpc servers, each pinned to its own core set so that
+        # concurrent measurements don't disturb each other. The builder runs
+        # one process per core left over, `build_cores` of them (a quarter
+        # by default) when `cores_per_server` isn't given. It isn't pinned,
+        # that would pin the calling thread for the whole tuning run.
+        # Use as a context manager, or call `close`
+        cores = sorted(os.sched_getaffinity(0))
+        if cores_per_server is None:
+            if build_cores is None:
+                build_cores = len(cores) // 4
+            cores_per_server = max(
+                (len(cores) - build_cores) // num_servers, 1)
+        num_measure_cores = num_servers * cores_per_server
+        if num_measure_cores > len(cores):
+            raise ValueError(f"{num_servers} servers x {cores_per_server} "
+                             f"cores don't fit in {len(cores)} cores")
+        build_core_set = cores[num_measure_cores:]
+        if not build_core_set:
+            logger.warning("no cores left for the builder, it shares the "
+                           "measure cores with one worker")
+            build_core_set = cores
+            build_workers = build_workers or 1
+
+        self.tracker = Tracker(port=9000, port_end=10000, silent=True)
+        device_key = "$local$device$%d" % self.tracker.port
+        self.servers = []
+        origin_num_threads = os.environ.get("TVM_NUM_THREADS")
+        try:
+            for idx in range(num_servers):
+                core_set = cores[idx * cores_per_server:(idx + 1) *
+                                 cores_per_server]
+                # the server process inherits affinity and thread count
+                os.sched_setaffinity(0, core_set)
+                os.environ["TVM_NUM_THREADS"] = str(len(core_set))
+                self.servers.append(
+                    Server(host="127.0.0.1",
+                           port=self.tracker.port,
+                           port_end=10000,
+                           key=device_key,
+                           use_popen=True,
+                           silent=True,
+                           tracker_addr=(self.tracker.host,
+                                         self.tracker.port)))
+                logger.info(f"start measure server {idx} on cores {core_set}")
+        finally:
+            os.sched_setaffinity(0, cores)
+            if origin_num_threads is None:
+                os.environ.pop("TVM_NUM_THREADS", None)
+            else:
+                os.environ["TVM_NUM_THREADS"] = origin_num_threads
+        self.builder = auto_scheduler.LocalBuilder(
+            timeout=timeout, n_parallel=build_workers or len(build_core_set))
+        self.runner = auto_scheduler.RPCRunner(
+            device_key,
+            host=self.tracker.host,
+            port=self.tracker.port,
+            priority=1,
+            n_parallel=num_servers,
+            timeout=timeout,
+            repeat=repeat,
+            min_repeat_ms=min_repeat_ms,
+            enable_cpu_cache_flush=enable_cpu_cache_flush,
+        )
+        # wait for servers to register to the tracker
+        time.sleep(0.5)
+
+    def close(self):
+        for server in self.servers:
+            server.terminate()
+        self.tracker.terminate()
+        self.servers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class MeasureThroughput(PythonBasedMeasureCallback):
+    def __init__(self):
+        super().__init__()
+        self.start = time.time()
+        self.num_trials = 0
+        self.num_valid = 0
+
+    def callback(self, policy, inputs, results):
+        self.num_trials += len(results)
+        self.num_valid += sum(res.error_no == 0 for res in results)
+
+    def report(self):
+        minutes = (time.time() - self.start) / 60
+        trials_per_minute = self.num_trials / max(minutes, 1e-9)
+        logger.info("Measured %d trials (%d valid) in %.1f min: "
+                    "%.1f trials/min" % (self.num_trials, self.num_valid,
+                                         minutes, trials_per_minute))
+        return trials_per_minute
@@ -1,24 +1,78 @@
+import numpy as np
+import tvm
 from tvm import relay
 
 
+def prepend_preprocess(mod,
+                       input_name,
+                       input_shape,
+                       raw_size=None,
+                       scale=1.0,
+                       mean=0.0,
+                       std=1.0):
+    # replace the NCHW input `input_name` of `mod` by a uint8 NHWC batch of
+    # `raw_size` (height, width), which is cast, resized (only if `raw_size`
+    # differs from `input_shape`), normalized by `(x * scale - mean) / std`
+    # per channel and transposed inside the graph. The math runs in the
+    # dtype of the original input (float32 for non-float inputs, which get
+    # one final cast)
+    main = relay.transform.InferType()(mod)["main"]
+    origin = next(p for p in main.params if p.name_hint == input_name)
+    input_dtype = origin.checked_type.dtype
+    dtype = input_dtype if input_dtype in ("float16", "float32",
+                                           "float64") else "float32"
+
+    batch_size, channels, height, width = input_shape
+    raw_height, raw_width = raw_size or (height, width)
+    data = relay.var(input_name,
+                     shape=(batch_size, raw_height, raw_width, channels),
+                     dtype="uint8")
+    x = relay.cast(data, dtype)
+    if (raw_height, raw_width) != (height, width):
+        x = relay.image.resize2d(x, (height, width),
+                                 layout="NHWC",
+                                 method="linear")
+    mean = np.broadcast_to(np.asarray(mean, "float64"), (channels, ))
+    std = np.broadcast_to(np.asarray(std, "float64"), (channels, ))
+    x = x * relay.const((scale / std).astype(dtype)) + \
+        relay.const((-mean / std).astype(dtype))
+    x = relay.transpose(x, (0, 3, 1, 2))
+    if dtype != input_dtype:
+        x = relay.cast(x, input_dtype)
+
+    params = [data if p.name_hint == input_name else p for p in main.params]
+    func = relay.Function(params, relay.bind(main.body, {origin: x}))
+    return relay.transform.InferType()(tvm.IRModule.from_expr(func))
+
+
 def mxnet_to_relay(model_prefix,
                    epoch,
                    dtype="float32",
                    input_name="data",
-                   input_shape=(1, 3, 112, 112)):
+                   input_shape=(1, 3, 112, 112),
+                   preprocess=None):
+    # `preprocess`: None for a float32 NCHW input, or kwargs of
+    # `prepend_preprocess` (e.g. `{}`, the model normalizes by itself) for
+    # a uint8 NHWC input
     import mxnet as mx
 
     shape_dict = {input_name: input_shape}
     sym, arg_params, aux_params = mx.model.load_checkpoint(model_prefix, epoch)
     mod, params = relay.frontend.from_mxnet(sym, shape_dict, dtype, arg_params,
                                             aux_params)
+    if preprocess is not None:
+        mod = prepend_preprocess(mod, input_name, input_shape, **preprocess)
     return mod, params
 
 
 def pytorch_to_relay(pytorch_module,
                      dtype="float32",
                      input_name="data",
-                     input_shape=(1, 3, 112, 112)):
+                     input_shape=(1, 3, 112, 112),
+                     preprocess=None):
+    # `preprocess`: see `mxnet_to_relay`, e.g.
+    # `{"scale": 1 / 255, "mean": [0.485, 0.456, 0.406],
+    #   "std": [0.229, 0.224, 0.225]}` for torchvision models
     import torch
     pytorch_module = pytorch_module.eval()
     input_data = torch.randn(input_shape)
@@ -27,4 +81,6 @@ def pytorch_to_relay(pytorch_module,
     mod, params = relay.frontend.from_pytorch(scripted_model,
                                               shape_list,
                                               default_dtype=dtype)
+    if preprocess is not None:
+        mod = prepend_preprocess(mod, input_name, input_shape, **preprocess)
     return mod, params
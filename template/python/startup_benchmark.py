@@ -0,0 +1,114 @@
+# Cold start of a deployment worker: time from process launch to the first
+# inference, split into interpreter start, imports, library load, executor
+# creation and first run. Every sample is a fresh interpreter
+import time
+
+_start = time.time()
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+STAGES = ("interpreter", "imports", "load_lib", "create_executor",
+          "first_run")
+# none of these should be loaded by a runtime-only worker
+FRAMEWORK_MODULES = ("mxnet", "torch", "onnx", "tvm.relay",
+                     "tvm.auto_scheduler", "tvm.autotvm")
+
+
+def _child(args):
+    # runs in the measured interpreter, prints the stage timestamps
+    stamps = {"interpreter": _start}
+    import numpy as np
+    import tvm
+    from tvm_deployment_utils import TvmDeployementTool
+    stamps["imports"] = time.time()
+
+    tool = TvmDeployementTool(args.lib_path,
+                              tvm.device(args.device),
+                              params_path=args.params_path)
+    stamps["load_lib"] = time.time()
+    module = tool.module
+    stamps["create_executor"] = time.time()
+    input_buf = module.get_input(args.input_name)
+    tool.inference(np.zeros(input_buf.shape, input_buf.dtype),
+                   args.input_name).asnumpy()
+    stamps["first_run"] = time.time()
+
+    stamps["frameworks"] = [m for m in FRAMEWORK_MODULES if m in sys.modules]
+    print(json.dumps(stamps))
+
+
+def measure_startup(lib_path,
+                    input_name="data",
+                    device="cpu",
+                    params_path=None,
+                    repeat=5,
+                    runtime_lib=False):
+    # returns one dict of stage milliseconds per sample. The first sample
+    # usually reads the library from disk, later ones from the page cache.
+    # `runtime_lib` loads libtvm_runtime instead of the full libtvm
+    cmd = [
+        sys.executable,
+        os.path.abspath(__file__), lib_path, "--child", "--input-name",
+        input_name, "--device", device
+    ]
+    if params_path is not None:
+        cmd += ["--params-path", params_path]
+    env = dict(os.environ)
+    if runtime_lib:
+        env["TVM_USE_RUNTIME_LIB"] = "1"
+
+    samples = []
+    for _ in range(repeat):
+        launch = time.time()
+        stdout = subprocess.run(cmd,
+                                stdout=subprocess.PIPE,
+                                env=env,
+                                check=True,
+                                universal_newlines=True).stdout
+        stamps = json.loads(stdout.strip().splitlines()[-1])
+        sample, prev = {}, launch
+        for stage in STAGES:
+            sample[stage] = (stamps[stage] - prev) * 1e3
+            prev = stamps[stage]
+        sample["total"] = (prev - launch) * 1e3
+        samples.append(sample)
+        if stamps["frameworks"]:
+            logger.warning(f"frameworks imported: {stamps['frameworks']}")
+    return samples
+
+
+def log_startup(samples):
+    first, rest = samples[0], samples[1:] or samples
+    logger.info("%-16s %10s %10s" % ("stage", "first ms", "median ms"))
+    for stage in STAGES + ("total", ):
+        median = sorted(s[stage] for s in rest)[len(rest) // 2]
+        logger.info("%-16s %10.1f %10.1f" % (stage, first[stage], median))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Break down the time to first inference of a library")
+    parser.add_argument("lib_path", help="library or batch bundle")
+    parser.add_argument("--input-name", default="data")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--params-path", default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--runtime-lib",
+                        action="store_true",
+                        help="set TVM_USE_RUNTIME_LIB=1 in the workers")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child(args)
+    else:
+        log_startup(
+            measure_startup(args.lib_path, args.input_name, args.device,
+                            args.params_path, args.repeat, args.runtime_lib))
@@ -1,36 +1,210 @@
+import json
 import logging
+import os
 
 import numpy as np
 import tvm
 from tvm.contrib import graph_executor
-import mxnet as mx
+
+from tvm_inference_utils import InferenceMixin
+from tvm_params_utils import bind_params, load_params
+from tvm_perf_history import MIN_SAMPLES, PerfHistory, host_cpu
+from tvm_serving_utils import GraphModulePool, benchmark_pool, \
+    config_threadpool
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
 INPUT_NAME = "data"
+BUNDLE_MANIFEST = "bundle.json"
+THREADS_CONFIG = "threads.json"
 
 
-class TvmDeployementTool:
-    def __init__(self, lib_path, dev=tvm.device("cuda", 0)):
-        self.lib = tvm.runtime.load_module(lib_path)
+class TvmDeployementTool(InferenceMixin):
+    def __init__(self,
+                 lib_path,
+                 dev=tvm.device("cuda", 0),
+                 reuse_input_buffers=True,
+                 params_path=None,
+                 num_threads=None,
+                 thread_mode=0,
+                 cpus=None):
+        # `lib_path` is either a single library or a batch bundle directory
+        # generated by `TvmDevelopmentUtils.export_batch_bundle`.
+        # `params_path` is the params file of a library exported by
+        # `export_lib(lib_path, params_path)`, it is memory-mapped so that
+        # workers on one host share the weight pages.
+        # `num_threads`, `thread_mode` and `cpus` configure the runtime
+        # thread pool, see `config_threads`. Without `num_threads`, the
+        # setting saved by `calibrate_threads` is used if there is one
+        self.lib_path = lib_path
         self.dev = dev
+        self.reuse_input_buffers = reuse_input_buffers
+        self.input_allocs = 0
+        self.buckets = None
+        self.params = None
+        if params_path is not None:
+            if os.path.isdir(lib_path):
+                raise ValueError("batch bundles don't support `params_path`")
+            self.params = load_params(params_path)
+        if os.path.isdir(lib_path):
+            with open(os.path.join(lib_path, BUNDLE_MANIFEST)) as f:
+                manifest = json.load(f)
+            self.buckets = sorted(int(b) for b in manifest["libs"])
+            self.bucket_libs = {
+                b: tvm.runtime.load_module(
+                    os.path.join(lib_path, manifest["libs"][str(b)]))
+                for b in self.buckets
+            }
+            self.lib = self.bucket_libs[self.buckets[0]]
+            logger.info(f"load batch bundle with buckets {self.buckets}")
+        else:
+            self.lib = tvm.runtime.load_module(lib_path)
+
+        self.thread_config = None
+        if num_threads is not None:
+            self.config_threads(num_threads, thread_mode, cpus)
+        else:
+            self._load_thread_config()
+
+    @property
+    def threads_config_path(self):
+        # saved next to the library
+        if os.path.isdir(self.lib_path):
+            return os.path.join(self.lib_path, THREADS_CONFIG)
+        return self.lib_path + "." + THREADS_CONFIG
+
+    def _load_thread_config(self):
+        if not os.path.exists(self.threads_config_path):
+            return
+        with open(self.threads_config_path) as f:
+            config = json.load(f)
+        if config["host_cpu"] != host_cpu():
+            logger.warning(f"ignore {self.threads_config_path}, calibrated "
+                           f"on {config['host_cpu']}")
+            return
+        logger.info(f"load thread config {self.threads_config_path}: "
+                    f"{config['num_threads']} threads")
+        self.config_threads(config["num_threads"], config["mode"],
+                            config["cpus"], config.get("pool_size"))
+
+    def config_threads(self, num_threads, mode=0, cpus=None, pool_size=None):
+        # thread pool of this tool's modules: `num_threads` threads on big
+        # (`mode` 1), little (-1) or all (0) cores, or pinned to `cpus`, e.g.
+        # `numa_cpus(node)`. TVM keeps one pool per calling thread, so the
+        # setting is applied before every run and tools with different
+        # settings can share a thread
+        self.thread_config = {
+            "num_threads": num_threads,
+            "mode": mode,
+            "cpus": None if cpus is None else list(cpus),
+            "pool_size": pool_size,
+        }
+        self._apply_threads()
+
+    def _apply_threads(self):
+        # a no-op unless another setting was applied in between
+        if self.thread_config is not None:
+            config_threadpool(self.thread_config["num_threads"],
+                              self.thread_config["mode"],
+                              self.thread_config["cpus"])
 
     @property
     def module(self):
         if getattr(self, '_module', None) is None:
             self._module = graph_executor.GraphModule(self.lib['default'](
                 self.dev))
+            if self.params is not None:
+                bind_params(self._module, self.params, self.dev)
         return self._module
 
-    def inference(self, inputs, input_name):
-        data_tvm = tvm.nd.array(inputs)
-        self.module.set_input(input_name, data_tvm)
-        self.module.run()
-        return self.module.get_output(0)
+    def module_pool(self, size=None, num_threads=None, params=None):
+        # thread-safe alternative to `self.module`, see `GraphModulePool`.
+        # `size` and `num_threads` default to the thread config
+        mode, cpus = 0, None
+        if self.thread_config is not None:
+            size = size or self.thread_config["pool_size"]
+            if num_threads is None:
+                num_threads = self.thread_config["num_threads"]
+                mode = self.thread_config["mode"]
+                cpus = self.thread_config["cpus"]
+        if size is None:
+            raise ValueError("no pool size given or calibrated")
+        setup = None
+        if self.params is not None:
+            # every instance reads the same mapped params
+            params = None
+            setup = lambda module: bind_params(module, self.params, self.dev)
+        return GraphModulePool(self.lib, self.dev, size, num_threads, params,
+                               setup, mode, cpus)
+
+    def bucket_module(self, batch_size):
+        if getattr(self, '_bucket_modules', None) is None:
+            self._bucket_modules = {}
+        if batch_size not in self._bucket_modules:
+            self._bucket_modules[batch_size] = graph_executor.GraphModule(
+                self.bucket_libs[batch_size]['default'](self.dev))
+        return self._bucket_modules[batch_size]
 
-    def evaluate(self, repeat=3, min_repeat_ms=500):
+    def inference(self, inputs, input_name, out=None):
+        if self.buckets is not None:
+            return self._bucket_inference(inputs, input_name, out)
+        self._apply_threads()
+        return super().inference(inputs, input_name, out)
+
+    def inference_outputs(self, inputs, input_name, copy=False):
+        if self.buckets is not None:
+            raise ValueError("batch bundles only support `inference`")
+        self._apply_threads()
+        return super().inference_outputs(inputs, input_name, copy)
+
+    def _pad_buffer(self, batch_size, chunk):
+        # padded rows are sliced off afterwards, so they are never cleared
+        if getattr(self, '_pad_buffers', None) is None:
+            self._pad_buffers = {}
+        shape = (batch_size, ) + chunk.shape[1:]
+        buf = self._pad_buffers.get(batch_size)
+        if buf is None or buf.shape != shape or buf.dtype != chunk.dtype:
+            buf = np.zeros(shape, chunk.dtype)
+            self._pad_buffers[batch_size] = buf
+        return buf
+
+    def _bucket_inference(self, inputs, input_name, out=None):
+        # split by the largest bucket, run every chunk with the smallest
+        # bucket that fits and drop the padded rows
+        results = out if isinstance(out, np.ndarray) else None
+        self._apply_threads()
+        for start in range(0, len(inputs), self.buckets[-1]):
+            chunk = inputs[start:start + self.buckets[-1]]
+            batch_size = next(b for b in self.buckets if b >= len(chunk))
+            num_valid = len(chunk)
+            if batch_size > num_valid:
+                padded = self._pad_buffer(batch_size, chunk)
+                padded[:num_valid] = chunk
+                chunk = padded
+            module = self.bucket_module(batch_size)
+            self._set_input(module, input_name, chunk)
+            module.run()
+            buf, view = self._output_buffer(module, 0)
+            module.get_output(0, buf)
+            if results is None:
+                results = np.empty((len(inputs), ) + view.shape[1:],
+                                   view.dtype)
+            results[start:start + num_valid] = view[:num_valid]
+        if out is None:
+            return tvm.nd.array(results)
+        if isinstance(out, tvm.nd.NDArray):
+            out.copyfrom(results)
+        return out
+
+    def evaluate(self, repeat=3, min_repeat_ms=500, history=None,
+                 model=None):
+        # see `TvmDevelopmentUtils.evaluate`, `model` defaults to the
+        # library file name
         logger.info("Evaluate inference time cost...")
+        if history is not None:
+            repeat = max(repeat, MIN_SAMPLES)
+        self._apply_threads()
         ftimer = self.module.module.time_evaluator("run",
                                                    self.dev,
                                                    repeat=repeat,
@@ -38,6 +212,84 @@ class TvmDeployementTool:
         prof_res = np.array(ftimer().results) * 1e3  # convert to millisecond
         logger.info("Mean inference time (std dev): %.2f ms (%.2f ms)" %
                     (np.mean(prof_res), np.std(prof_res)))
+        if history is not None:
+            PerfHistory(history).append(
+                model or os.path.basename(self.lib_path),
+                self.dev,
+                prof_res,
+                lib=self.lib,
+                params=self.params)
+        return prof_res
+
+    def calibrate_threads(self,
+                          inputs,
+                          input_name,
+                          objective="latency",
+                          thread_counts=None,
+                          mode=0,
+                          cpus=None,
+                          repeat=5,
+                          min_repeat_ms=200,
+                          num_requests=500,
+                          save=True):
+        # sweep the thread count and apply the best setting. "latency" times
+        # one module with `time_evaluator` and picks the lowest median,
+        # "throughput" splits the cores into a module pool of
+        # `cores // num_threads` instances (see `benchmark_pool`) and picks
+        # the most requests/s. With `save`, the setting is written next to
+        # the library and loaded by later tools on the same host cpu
+        if self.buckets is not None:
+            raise ValueError("batch bundles don't support `calibrate_threads`")
+        if objective not in ("latency", "throughput"):
+            raise ValueError(f"unknown objective {objective}")
+        num_cores = len(cpus) if cpus is not None else os.cpu_count()
+        if thread_counts is None:
+            # powers of two and all cores
+            thread_counts = sorted({num_cores} | {
+                2**i
+                for i in range(num_cores.bit_length())
+            })
+
+        results = {}
+        for num_threads in thread_counts:
+            if objective == "latency":
+                config_threadpool(num_threads, mode, cpus)
+                self._set_input(self.module, input_name, inputs)
+                ftimer = self.module.module.time_evaluator(
+                    "run", self.dev, repeat=repeat,
+                    min_repeat_ms=min_repeat_ms)
+                results[num_threads] = float(
+                    np.median(ftimer().results) * 1e3)
+                logger.info("%d threads: %.2f ms" %
+                            (num_threads, results[num_threads]))
+            else:
+                pool = GraphModulePool(
+                    self.lib, self.dev, max(num_cores // num_threads, 1),
+                    num_threads,
+                    setup=None if self.params is None else
+                    lambda module: bind_params(module, self.params, self.dev),
+                    mode=mode,
+                    cpus=cpus)
+                results[num_threads] = benchmark_pool(pool, inputs,
+                                                      input_name,
+                                                      num_requests)
+        pick = min if objective == "latency" else max
+        num_threads = pick(results, key=results.get)
+        pool_size = max(num_cores // num_threads, 1) \
+            if objective == "throughput" else None
+        logger.info(f"calibrated {objective}: {num_threads} threads"
+                    + (f", pool size {pool_size}" if pool_size else ""))
+        self.config_threads(num_threads, mode, cpus, pool_size)
+
+        if save:
+            config = dict(self.thread_config,
+                          objective=objective,
+                          results={str(n): v
+                                   for n, v in results.items()},
+                          host_cpu=host_cpu())
+            with open(self.threads_config_path, "w") as f:
+                json.dump(config, f, indent=2)
+        return results
 
 
 if __name__ == '__main__':
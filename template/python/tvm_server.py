@@ -0,0 +1,420 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+# request: payload bytes (uint64), then the raw input of one slot
+REQUEST_HEADER = struct.Struct("<Q")
+# response: status (0 for ok), payload bytes, then the raw output or an
+# utf-8 error message
+RESPONSE_HEADER = struct.Struct("<iQ")
+# handshake: json bytes (uint32), then json with input/output shapes
+HANDSHAKE_HEADER = struct.Struct("<I")
+
+
+def _recv_into(conn, view):
+    # fill `view` completely, False if the peer closed the connection
+    while len(view):
+        nbytes = conn.recv_into(view)
+        if nbytes == 0:
+            return False
+        view = view[nbytes:]
+    return True
+
+
+def _worker_main(idx, lib_path, params_path, dev_type, input_name,
+                 input_shm_name, num_slots, input_shape, input_dtype,
+                 num_threads, tasks, results):
+    # runs in a spawned process, which owns its own TVM runtime and GIL.
+    # All shared memory is created and unlinked by the server, setup
+    # errors are sent back as ("error", idx, message)
+    try:
+        import tvm
+        from tvm_deployment_utils import TvmDeployementTool
+        from tvm_serving_utils import config_threadpool
+
+        if num_threads is not None:
+            config_threadpool(num_threads)
+        tool = TvmDeployementTool(lib_path,
+                                  tvm.device(dev_type),
+                                  params_path=params_path)
+        input_shm = shared_memory.SharedMemory(input_shm_name)
+        inputs = np.ndarray((num_slots, ) + tuple(input_shape), input_dtype,
+                            input_shm.buf)
+        # only the library knows the output shape, the server creates the
+        # output ring from it and sends back its name
+        output = tool.inference(inputs[0], input_name).asnumpy()
+    except Exception as e:
+        results.put(("error", idx, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", idx, output.shape, str(output.dtype)))
+    output_shm_name = tasks.get()
+    if output_shm_name is None:
+        # the server shut down during startup
+        return
+    output_shm = shared_memory.SharedMemory(output_shm_name)
+    outputs = np.ndarray((num_slots, ) + output.shape, output.dtype,
+                         output_shm.buf)
+
+    while True:
+        slot = tasks.get()
+        if slot is None:
+            break
+        start = time.perf_counter()
+        error = None
+        try:
+            tool.inference(inputs[slot], input_name, out=outputs[slot])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        results.put(("done", idx, slot, time.perf_counter() - start, error))
+
+    del inputs, outputs
+    input_shm.close()
+    output_shm.close()
+
+
+class InferenceServer:
+    def __init__(self,
+                 lib_path,
+                 input_name,
+                 input_shape,
+                 socket_path,
+                 num_workers=2,
+                 num_slots=4,
+                 input_dtype="float32",
+                 dev_type="cpu",
+                 params_path=None,
+                 num_threads=None,
+                 startup_timeout=300):
+        # `num_workers` processes each own a `TvmDeployementTool` and a ring
+        # of `num_slots` input/output slots in shared memory. Clients send
+        # raw inputs over `socket_path`, which are received directly into a
+        # free slot and never pickled. Raises RuntimeError when a worker
+        # fails to start within `startup_timeout` seconds
+        self.input_name = input_name
+        self.input_shape = tuple(input_shape)
+        self.input_dtype = np.dtype(input_dtype)
+        self.input_nbytes = int(np.prod(self.input_shape)) * \
+            self.input_dtype.itemsize
+        self.socket_path = socket_path
+        self.num_workers = num_workers
+        self.num_slots = num_slots
+        if num_threads is None and dev_type == "cpu":
+            num_threads = max(os.cpu_count() // num_workers, 1)
+
+        ctx = multiprocessing.get_context("spawn")
+        self._results = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(num_workers)]
+        self._input_shms = []
+        self._inputs = []
+        self._workers = []
+        for idx in range(num_workers):
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=num_slots *
+                                             self.input_nbytes)
+            self._input_shms.append(shm)
+            self._inputs.append(
+                np.ndarray((num_slots, ) + self.input_shape,
+                           self.input_dtype, shm.buf))
+            worker = ctx.Process(target=_worker_main,
+                                 args=(idx, lib_path, params_path, dev_type,
+                                       input_name, shm.name, num_slots,
+                                       self.input_shape, str(
+                                           self.input_dtype), num_threads,
+                                       self._tasks[idx], self._results),
+                                 daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        self._output_shms = []
+        self._outputs = [None] * num_workers
+        try:
+            self._wait_workers(startup_timeout)
+        except Exception:
+            self._shutdown()
+            raise
+        self.output_shape = self._outputs[0].shape[1:]
+        self.output_dtype = self._outputs[0].dtype
+
+        # slots are handed out interleaved, so that requests spread over
+        # workers. A request waits for a free slot when all rings are full
+        self._free_slots = queue.Queue()
+        for slot in range(num_slots):
+            for idx in range(num_workers):
+                self._free_slots.put((idx, slot))
+        self._pending = {}
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        self._stopped = False
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True)
+        self._dispatcher.start()
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(socket_path)
+        self._sock.listen()
+        self._acceptor = threading.Thread(target=self._accept, daemon=True)
+        self._acceptor.start()
+        logger.info(f"serve {num_workers} workers x {num_slots} slots "
+                    f"on {socket_path}")
+
+    def _wait_workers(self, timeout):
+        # create the output ring of every worker once it reports its output
+        # shape
+        deadline = time.monotonic() + timeout
+        for _ in range(self.num_workers):
+            while True:
+                try:
+                    item = self._results.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    self._check_workers()
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(
+                            f"workers not ready after {timeout} s")
+            if item[0] == "error":
+                raise RuntimeError(f"worker {item[1]} failed: {item[2]}")
+            _, idx, shape, dtype = item
+            shm = shared_memory.SharedMemory(
+                create=True,
+                size=self.num_slots * int(np.prod(shape)) *
+                np.dtype(dtype).itemsize)
+            self._output_shms.append(shm)
+            self._outputs[idx] = np.ndarray((self.num_slots, ) + tuple(shape),
+                                            dtype, shm.buf)
+            self._tasks[idx].put(shm.name)
+
+    def _check_workers(self):
+        for idx, worker in enumerate(self._workers):
+            if not worker.is_alive():
+                raise RuntimeError(f"worker {idx} exited with code "
+                                   f"{worker.exitcode}")
+
+    @property
+    def handshake(self):
+        return {
+            "input_shape": list(self.input_shape),
+            "input_dtype": str(self.input_dtype),
+            "output_shape": list(self.output_shape),
+            "output_dtype": str(self.output_dtype),
+        }
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            if self._stopped:
+                conn.close()
+                break
+            threading.Thread(target=self._handle, args=(conn, ),
+                             daemon=True).start()
+
+    def _handle(self, conn):
+        # one thread per connection, socket io releases the GIL
+        header = bytearray(REQUEST_HEADER.size)
+        with conn:
+            handshake = json.dumps(self.handshake).encode()
+            conn.sendall(HANDSHAKE_HEADER.pack(len(handshake)) + handshake)
+            while _recv_into(conn, memoryview(header)):
+                nbytes, = REQUEST_HEADER.unpack(header)
+                if nbytes != self.input_nbytes:
+                    message = (f"expect {self.input_nbytes} bytes, "
+                               f"got {nbytes}").encode()
+                    conn.sendall(RESPONSE_HEADER.pack(1, len(message)) +
+                                 message)
+                    break
+                idx, slot = self._free_slots.get()
+                try:
+                    view = memoryview(self._inputs[idx][slot]).cast("B")
+                    if not _recv_into(conn, view):
+                        break
+                    error = self._run(idx, slot)
+                    if error is None:
+                        output = self._outputs[idx][slot]
+                        conn.sendall(RESPONSE_HEADER.pack(0, output.nbytes))
+                        conn.sendall(memoryview(output).cast("B"))
+                    else:
+                        message = error.encode()
+                        conn.sendall(
+                            RESPONSE_HEADER.pack(1, len(message)) + message)
+                finally:
+                    self._free_slots.put((idx, slot))
+
+    def _run(self, idx, slot):
+        # returns an error message if the request failed or the worker died
+        worker = self._workers[idx]
+        if not worker.is_alive():
+            return f"worker {idx} exited with code {worker.exitcode}"
+        done = threading.Event()
+        self._pending[(idx, slot)] = [done, None]
+        self._tasks[idx].put(slot)
+        while not done.wait(timeout=1.0):
+            if not worker.is_alive():
+                self._pending.pop((idx, slot))
+                return f"worker {idx} exited with code {worker.exitcode}"
+        return self._pending.pop((idx, slot))[1]
+
+    def _dispatch(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            _, idx, slot, busy_s, error = item
+            with self._stats_lock:
+                self._requests[idx] += 1
+                self._busy_s[idx] += busy_s
+            pending = self._pending.get((idx, slot))
+            if pending is not None:
+                pending[1] = error
+                pending[0].set()
+
+    def _reset_stats(self):
+        self._start = time.perf_counter()
+        self._requests = [0] * self.num_workers
+        self._busy_s = [0.] * self.num_workers
+
+    def stats(self, reset=False):
+        # utilisation: share of wall time a worker spent in `inference`
+        with self._stats_lock:
+            wall_s = max(time.perf_counter() - self._start, 1e-9)
+            res = {
+                "wall_s": wall_s,
+                "requests_per_s": sum(self._requests) / wall_s,
+                "workers": [{
+                    "requests": self._requests[idx],
+                    "busy_s": self._busy_s[idx],
+                    "utilisation": self._busy_s[idx] / wall_s,
+                } for idx in range(self.num_workers)],
+            }
+            if reset:
+                self._reset_stats()
+        return res
+
+    def log_stats(self, reset=False):
+        res = self.stats(reset)
+        logger.info(
+            "%.1f requests/s, worker utilisation: %s" %
+            (res["requests_per_s"], ", ".join(
+                "%.0f%%" % (w["utilisation"] * 100) for w in res["workers"])))
+        return res
+
+    def close(self):
+        self._stopped = True
+        # closing alone doesn't wake a thread blocked in `accept`
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._acceptor.join()
+        os.unlink(self.socket_path)
+        self._results.put(None)
+        self._dispatcher.join()
+        self._shutdown()
+
+    def _shutdown(self, timeout=10):
+        # stop the workers, then free the shared memory
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._inputs, self._outputs = [], []
+        for shm in self._input_shms + self._output_shms:
+            shm.close()
+            shm.unlink()
+
+
+class InferenceClient:
+    def __init__(self, socket_path):
+        # one request in flight per client, use a client per thread
+        self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._conn.connect(socket_path)
+        header = bytearray(HANDSHAKE_HEADER.size)
+        _recv_into(self._conn, memoryview(header))
+        handshake = bytearray(HANDSHAKE_HEADER.unpack(header)[0])
+        _recv_into(self._conn, memoryview(handshake))
+        self.handshake = json.loads(handshake)
+        self._header = bytearray(RESPONSE_HEADER.size)
+
+    def inference(self, inputs, out=None):
+        inputs = np.ascontiguousarray(inputs,
+                                      self.handshake["input_dtype"])
+        if list(inputs.shape) != self.handshake["input_shape"]:
+            raise ValueError(f"expect input shape "
+                             f"{self.handshake['input_shape']}, "
+                             f"got {list(inputs.shape)}")
+        self._conn.sendall(REQUEST_HEADER.pack(inputs.nbytes))
+        self._conn.sendall(memoryview(inputs).cast("B"))
+        if not _recv_into(self._conn, memoryview(self._header)):
+            raise ConnectionError("server closed the connection")
+        status, nbytes = RESPONSE_HEADER.unpack(self._header)
+        if status != 0:
+            message = bytearray(nbytes)
+            _recv_into(self._conn, memoryview(message))
+            raise RuntimeError(message.decode())
+        if out is None:
+            out = np.empty(self.handshake["output_shape"],
+                           self.handshake["output_dtype"])
+        _recv_into(self._conn, memoryview(out).cast("B"))
+        return out
+
+    def close(self):
+        self._conn.close()
+
+
+def benchmark_server(socket_path, inputs, num_requests=1000,
+                     num_clients=8):
+    clients = [InferenceClient(socket_path) for _ in range(num_clients)]
+
+    def run(client, count):
+        out = None
+        for _ in range(count):
+            out = client.inference(inputs, out)
+
+    counts = [num_requests // num_clients] * num_clients
+    for client in clients:
+        client.inference(inputs)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_clients) as executor:
+        list(executor.map(run, clients, counts))
+    throughput = sum(counts) / (time.perf_counter() - start)
+    for client in clients:
+        client.close()
+    logger.info("%d clients: %.2f requests/s" % (num_clients, throughput))
+    return throughput
+
+
+if __name__ == '__main__':
+    # throughput scaling with worker count
+    lib_path = "/ssd01/zhangyiyang/tvm_examples/insightface/lib/cpu.so"
+    inputs = np.ones((1, 3, 112, 112), np.float32)
+    for num_workers in (1, 2, 4):
+        server = InferenceServer(lib_path,
+                                 "data",
+                                 inputs.shape,
+                                 "/tmp/tvm_server.sock",
+                                 num_workers=num_workers)
+        server.stats(reset=True)
+        benchmark_server(server.socket_path, inputs,
+                         num_clients=4 * num_workers)
+        server.log_stats()
+        server.close()
@@ -0,0 +1,482 @@
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import tvm
+from tvm.contrib import graph_executor
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger()
+
+_thread_config = threading.local()
+
+
+def parse_cpulist(cpulist):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_cpus(node):
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        return parse_cpulist(f.read())
+
+
+def _supports_cpu_list():
+    # `runtime.config_threadpool` takes a cpu list since TVM 0.9
+    try:
+        major, minor = (int(v)
+                        for v in re.findall(r"\d+", tvm.__version__)[:2])
+    except ValueError:
+        return False
+    return (major, minor) >= (0, 9)
+
+
+def config_threadpool(num_threads, mode=0, cpus=None):
+    # TVM keeps one thread pool per calling thread, so this only affects
+    # modules run from the current thread. `mode`: 1 for big cores, -1 for
+    # little cores, 0 for all. `cpus` pins the pool to a core set, e.g. a
+    # NUMA node (`numa_cpus(node)`), and overrides `mode`
+    key = (mode, num_threads, None if cpus is None else tuple(cpus))
+    if getattr(_thread_config, "value", None) == key:
+        return
+    func = tvm.get_global_func("runtime.config_threadpool")
+    if cpus is None:
+        func(mode, num_threads)
+    elif _supports_cpu_list():
+        # TVM pins the pool threads, all of them share the given cores
+        func(-3, num_threads, [str(cpu) for cpu in cpus])
+    else:
+        # older runtimes create the pool threads here and they inherit the
+        # affinity of the calling thread. Keep TVM from re-pinning them, then
+        # restore the calling thread and the environment, so that other
+        # settings in this process are unaffected
+        affinity = os.sched_getaffinity(0)
+        bind_threads = os.environ.get("TVM_BIND_THREADS")
+        os.sched_setaffinity(0, cpus)
+        os.environ["TVM_BIND_THREADS"] = "0"
+        try:
+            func(0, num_threads)
+        finally:
+            os.sched_setaffinity(0, affinity)
+            if bind_threads is None:
+                del os.environ["TVM_BIND_THREADS"]
+            else:
+                os.environ["TVM_BIND_THREADS"] = bind_threads
+    _thread_config.value = key
+
+
+class DynamicBatcher:
+    def __init__(self, tool, input_name, max_batch_size=8, max_wait_us=1000):
+        # `tool` should accept any batch size up to `max_batch_size`,
+        # e.g. a `TvmDeployementTool` loaded from a batch bundle
+        self.tool = tool
+        self.input_name = input_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_us = max_wait_us
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        # orders `submit` against `close`, so nothing is queued after the
+        # stop marker
+        self._close_lock = threading.Lock()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, sample):
+        # `sample` has no batch dim, the future resolves to its output row
+        future = Future()
+        with self._close_lock:
+            if self._stopped:
+                raise RuntimeError("batcher is closed")
+            self._queue.put((sample, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        with self._close_lock:
+            if not self._stopped:
+                self._stopped = True
+                self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return []
+        requests = [item]
+        # wait at most `max_wait_us` after the oldest request arrived
+        deadline = item[2] + self.max_wait_us * 1e-6
+        while len(requests) < self.max_batch_size:
+            # past the deadline, only take requests that are already queued
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            requests.append(item)
+        return requests
+
+    def _loop(self):
+        while True:
+            requests = self._collect()
+            if not requests:
+                break
+            start = time.perf_counter()
+            try:
+                batch = np.stack([r[0] for r in requests])
+                outputs = self.tool.inference(batch,
+                                              self.input_name).asnumpy()
+            except Exception as e:
+                for _, future, _ in requests:
+                    future.set_exception(e)
+                continue
+            for idx, (_, future, _) in enumerate(requests):
+                future.set_result(outputs[idx])
+            self._update_stats(requests, start, time.perf_counter())
+
+        # fail requests left behind by `close`
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                item[1].set_exception(RuntimeError("batcher is closed"))
+
+    def _reset_stats(self):
+        self._num_batches = 0
+        self._num_samples = 0
+        self._batch_sizes = {}
+        self._queue_us = 0.
+        self._max_queue_us = 0.
+        self._run_us = 0.
+
+    def _update_stats(self, requests, start, end):
+        with self._stats_lock:
+            self._num_batches += 1
+            self._num_samples += len(requests)
+            self._batch_sizes[len(requests)] = \
+                self._batch_sizes.get(len(requests), 0) + 1
+            for _, _, arrival in requests:
+                queue_us = (start - arrival) * 1e6
+                self._queue_us += queue_us
+                self._max_queue_us = max(self._max_queue_us, queue_us)
+            self._run_us += (end - start) * 1e6
+
+    def stats(self, reset=False):
+        with self._stats_lock:
+            num_batches = max(self._num_batches, 1)
+            num_samples = max(self._num_samples, 1)
+            res = {
+                "queue_depth": self._queue.qsize(),
+                "num_batches": self._num_batches,
+                "num_samples": self._num_samples,
+                "mean_batch_size": self._num_samples / num_batches,
+                "batch_size_histogram": dict(sorted(
+                    self._batch_sizes.items())),
+                "mean_added_latency_us": self._queue_us / num_samples,
+                "max_added_latency_us": self._max_queue_us,
+                "mean_run_us": self._run_us / num_batches,
+            }
+            if reset:
+                self._reset_stats()
+        return res
+
+    def log_stats(self, reset=False):
+        res = self.stats(reset)
+        logger.info(
+            "queue depth %d, mean batch size %.2f, "
+            "added latency mean/max %.1f/%.1f us, run %.1f us" %
+            (res["queue_depth"], res["mean_batch_size"],
+             res["mean_added_latency_us"], res["max_added_latency_us"],
+             res["mean_run_us"]))
+        return res
+
+
+class GraphModulePool:
+    def __init__(self,
+                 lib,
+                 dev,
+                 size,
+                 num_threads=None,
+                 params=None,
+                 setup=None,
+                 mode=0,
+                 cpus=None):
+        # all instances are created from the same loaded `lib`. With `params`
+        # (dict or bytes from `tvm.runtime.save_param_dict`), the instances
+        # share the constant params of the first one instead of copying them.
+        # `setup(module)` runs on every new instance, e.g. to bind params.
+        # `num_threads`, `mode` and `cpus` go to `config_threadpool`
+        self.size = size
+        self.num_threads = num_threads
+        self.mode = mode
+        self.cpus = cpus
+        self._modules = queue.Queue()
+
+        base = graph_executor.GraphModule(lib['default'](dev))
+        self._modules.put(base)
+        if params is not None and not isinstance(params, (bytes, bytearray)):
+            params = tvm.runtime.save_param_dict(params)
+        for _ in range(size - 1):
+            if params is None:
+                module = graph_executor.GraphModule(lib['default'](dev))
+            else:
+                module = graph_executor.GraphModule(
+                    lib['remove_params']()['default'](dev))
+                module.share_params(base, params)
+            self._modules.put(module)
+        if setup is not None:
+            for module in list(self._modules.queue):
+                setup(module)
+        logger.info(f"create {size} graph modules, "
+                    f"share params: {params is not None}")
+
+    def acquire(self, timeout=None):
+        module = self._modules.get(timeout=timeout)
+        if self.num_threads is not None:
+            config_threadpool(self.num_threads, self.mode, self.cpus)
+        return module
+
+    def release(self, module):
+        self._modules.put(module)
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        module = self.acquire(timeout)
+        try:
+            yield module
+        finally:
+            self.release(module)
+
+    def inference(self, inputs, input_name):
+        # copy the output before the module goes back to the pool
+        with self.checkout() as module:
+            module.set_input(input_name, tvm.nd.array(inputs))
+            module.run()
+            return module.get_output(0).asnumpy()
+
+
+class EmbeddingCache:
+    def __init__(self,
+                 tool,
+                 input_name,
+                 max_bytes=256 * 1024**2,
+                 spill_dir=None,
+                 spill_max_bytes=4 * 1024**3):
+        # outputs of `tool.inference` keyed by a hash of the input bytes.
+        # Least recently used outputs are evicted past `max_bytes`, to
+        # `spill_dir` if set, which keeps at most `spill_max_bytes`.
+        # `tool` is a `TvmDeployementTool`/`TvmDevelopmentUtils` (calls are
+        # serialized) or a thread-safe `GraphModulePool`
+        self.tool = tool
+        self.input_name = input_name
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._tool_lock = None if isinstance(
+            tool, GraphModulePool) else threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._disk = collections.OrderedDict()
+        # concurrent misses of one key share a single forward pass
+        self._inflight = {}
+        self.bytes_used = 0
+        self.disk_bytes_used = 0
+        self._reset_stats()
+
+    @staticmethod
+    def make_key(inputs):
+        inputs = np.ascontiguousarray(inputs)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{inputs.dtype}{inputs.shape}".encode())
+        h.update(memoryview(inputs).cast("B"))
+        return h.hexdigest()
+
+    def inference(self, inputs):
+        # returns a numpy output, shared with the cache: don't modify it
+        key = self.make_key(inputs)
+        with self._lock:
+            output = self._lookup(key)
+            if output is not None:
+                return output
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self._misses += 1
+            else:
+                self._hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            output = self._run(inputs)
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._insert(key, output)
+            self._inflight.pop(key)
+        future.set_result(output)
+        return output
+
+    def _run(self, inputs):
+        if self._tool_lock is None:
+            output = self.tool.inference(inputs, self.input_name)
+        else:
+            # the tool reuses its buffers, copy before releasing the lock
+            with self._tool_lock:
+                output = self.tool.inference(inputs, self.input_name)
+                output = np.array(
+                    output.asnumpy() if hasattr(output, "asnumpy") else output)
+        output.setflags(write=False)
+        return output
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key + ".npy")
+
+    def _lookup(self, key):
+        # called with `self._lock` held
+        output = self._memory.get(key)
+        if output is not None:
+            self._memory.move_to_end(key)
+            self._hits += 1
+            return output
+        if key in self._disk:
+            output = np.load(self._spill_path(key))
+            output.setflags(write=False)
+            os.remove(self._spill_path(key))
+            self.disk_bytes_used -= self._disk.pop(key)
+            self._disk_hits += 1
+            self._hits += 1
+            self._insert(key, output)
+            return output
+        return None
+
+    def _insert(self, key, output):
+        # called with `self._lock` held
+        if key in self._memory:
+            return
+        self._memory[key] = output
+        self.bytes_used += output.nbytes
+        while self.bytes_used > self.max_bytes and len(self._memory) > 1:
+            old_key, old_output = self._memory.popitem(last=False)
+            self.bytes_used -= old_output.nbytes
+            self._evictions += 1
+            if self.spill_dir is not None:
+                self._spill(old_key, old_output)
+
+    def _spill(self, key, output):
+        np.save(self._spill_path(key), output)
+        nbytes = os.path.getsize(self._spill_path(key))
+        self._disk[key] = nbytes
+        self.disk_bytes_used += nbytes
+        while self.disk_bytes_used > self.spill_max_bytes and self._disk:
+            old_key, old_nbytes = self._disk.popitem(last=False)
+            os.remove(self._spill_path(old_key))
+            self.disk_bytes_used -= old_nbytes
+
+    def _reset_stats(self):
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def stats(self, reset=False):
+        with self._lock:
+            requests = self._hits + self._misses
+            res = {
+                "requests": requests,
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / max(requests, 1),
+                "evictions": self._evictions,
+                "entries": len(self._memory),
+                "bytes_used": self.bytes_used,
+                "disk_entries": len(self._disk),
+                "disk_bytes_used": self.disk_bytes_used,
+            }
+            if reset:
+                self._reset_stats()
+        return res
+
+    def log_stats(self, reset=False):
+        res = self.stats(reset)
+        logger.info("hit rate %.2f%% (%d/%d, %d from disk), "
+                    "%d entries %.2f MB, %d spilled %.2f MB" %
+                    (res["hit_rate"] * 100, res["hits"], res["requests"],
+                     res["disk_hits"], res["entries"],
+                     res["bytes_used"] / 2**20, res["disk_entries"],
+                     res["disk_bytes_used"] / 2**20))
+        return res
+
+
+def benchmark_pool(pool, inputs, input_name, num_requests=1000,
+                   concurrency=None):
+    concurrency = concurrency or pool.size
+    with ThreadPoolExecutor(concurrency) as executor:
+        # warm up every instance
+        list(executor.map(lambda _: pool.inference(inputs, input_name),
+                          range(pool.size)))
+        start = time.perf_counter()
+        list(
+            executor.map(lambda _: pool.inference(inputs, input_name),
+                         range(num_requests)))
+        cost = time.perf_counter() - start
+    throughput = num_requests / cost
+    logger.info("pool size %d, %s threads per module: %.2f requests/s" %
+                (pool.size, pool.num_threads, throughput))
+    return throughput
+
+
+if __name__ == '__main__':
+    from tvm_deployment_utils import TvmDeployementTool, INPUT_NAME
+
+    tool = TvmDeployementTool(
+        "/ssd01/zhangyiyang/tvm_examples/insightface/lib/bundle",
+        tvm.device("cpu"))
+    batcher = DynamicBatcher(tool, INPUT_NAME, max_batch_size=8,
+                             max_wait_us=2000)
+    futures = [
+        batcher.submit(np.ones((3, 112, 112), np.float32))
+        for _ in range(100)
+    ]
+    print([f.result().reshape(-1)[:2] for f in futures[:3]])
+    batcher.log_stats()
+    batcher.close()
+
+    # throughput scaling with pool size
+    tool = TvmDeployementTool(
+        "/ssd01/zhangyiyang/tvm_examples/insightface/lib/cpu.so",
+        tvm.device("cpu"))
+    inputs = np.ones((1, 3, 112, 112), np.float32)
+    for size in (1, 2, 4, 8, 16):
+        pool = tool.module_pool(size, max(os.cpu_count() // size, 1))
+        benchmark_pool(pool, inputs, INPUT_NAME)
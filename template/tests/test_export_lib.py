@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tvm = pytest.importorskip("tvm")
+from tvm import relay
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                    "python"))
+
+from tvm_deployment_utils import TvmDeployementTool
+from tvm_development_utils import TvmDevelopmentUtils
+from tvm_perf_history import lib_hash
+
+IMAGE_SIZE = (1, 3, 8, 8)
+
+
+class TinyConvUtils(TvmDevelopmentUtils):
+    def network_fn(self):
+        data = relay.var("data", shape=self.image_size, dtype="float32")
+        weight = relay.var("weight", shape=(4, 3, 3, 3), dtype="float32")
+        out = relay.nn.relu(relay.nn.conv2d(data, weight, padding=(1, 1)))
+        mod = tvm.IRModule.from_expr(relay.Function([data, weight], out))
+        rng = np.random.RandomState(0)
+        params = {
+            "weight": tvm.nd.array(rng.rand(4, 3, 3, 3).astype(np.float32))
+        }
+        return mod, params
+
+
+def _tool(tmp_path, **kwargs):
+    return TinyConvUtils("tiny-conv",
+                         IMAGE_SIZE,
+                         tvm.target.Target("llvm"),
+                         layout="NCHW",
+                         log_file=str(tmp_path / "tiny-conv.json"),
+                         **kwargs)
+
+
+def _check_export(tool, tmp_path, expected):
+    lib_path = str(tmp_path / "lib.so")
+    params_path = str(tmp_path / "lib.params")
+    tool.export_lib(lib_path, params_path)
+    deploy = TvmDeployementTool(lib_path,
+                                tvm.cpu(0),
+                                params_path=params_path)
+    inputs = np.ones(IMAGE_SIZE, np.float32)
+    np.testing.assert_allclose(
+        deploy.inference(inputs, "data").asnumpy(), expected, rtol=1e-5)
+    # the deployed library hashes like the one it was exported from
+    assert lib_hash(deploy.lib, deploy.params) == lib_hash(tool.lib)
+
+
+def test_export_lib_from_build_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    inputs = np.ones(IMAGE_SIZE, np.float32)
+    expected = _tool(tmp_path, cache_dir=cache_dir).inference(
+        inputs, "data").asnumpy()
+
+    # the second tool loads a `runtime.Module` from the cache
+    tool = _tool(tmp_path, cache_dir=cache_dir)
+    assert not hasattr(tool.lib, "get_params")
+    _check_export(tool, tmp_path, expected)
+
+
+def test_export_lib_from_deserialized_lib(tmp_path):
+    inputs = np.ones(IMAGE_SIZE, np.float32)
+    tool = _tool(tmp_path)
+    expected = tool.inference(inputs, "data").asnumpy()
+    full_lib_path = str(tmp_path / "full.so")
+    tool.export_lib(full_lib_path)
+
+    _check_export(_tool(tmp_path, lib_path=full_lib_path), tmp_path,
+                  expected)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+tvm = pytest.importorskip("tvm")
+from tvm import relay
+from tvm.contrib import graph_executor
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                    "python"))
+
+from tvm_inference_utils import InferenceMixin
+
+SHAPE = (2, 3)
+
+
+class AddOneTool(InferenceMixin):
+    def __init__(self):
+        data = relay.var("data", shape=SHAPE, dtype="float32")
+        mod = tvm.IRModule.from_expr(
+            relay.Function([data], data + relay.const(1.0)))
+        with tvm.transform.PassContext(opt_level=3):
+            lib = relay.build(mod, target="llvm")
+        self.dev = tvm.cpu(0)
+        self.module = graph_executor.GraphModule(lib["default"](self.dev))
+        self.reuse_input_buffers = True
+        self.input_allocs = 0
+
+
+def test_alternate_ndarray_and_numpy_inputs():
+    tool = AddOneTool()
+    rng = np.random.RandomState(0)
+    for step in range(6):
+        inputs = rng.rand(*SHAPE).astype(np.float32)
+        if step % 3 == 1:
+            arg = tvm.nd.array(inputs)
+        elif step % 3 == 2:
+            arg = inputs.tolist()
+        else:
+            arg = inputs
+        np.testing.assert_allclose(
+            tool.inference(arg, "data").asnumpy(), inputs + 1, rtol=1e-6)
+    # one buffer for every input type
+    assert tool.input_allocs == 1